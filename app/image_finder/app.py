@@ -1,20 +1,37 @@
+import asyncio
 import base64
+import email.utils
+import hashlib
+import hmac
+import io
 import json
 import logging
 import os
-import re
-import tempfile
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import faiss
 import numpy as np
 import torch
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Header, Query, Response, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from PIL import Image, ImageOps
-from transformers import CLIPModel, CLIPProcessor
+
+from encoders import ImageEncoder, load_vision_model
+from http_cache import image_etag, is_not_modified
+from index_shards import (INDEX_SHARDS_DIR, SHARDS_MANIFEST, ShardedIndex, apply_search_params, load_manifest,
+                          read_index_file, selector_search_params)
+from metadata_store import COLUMNS_DIR, COLUMNS_FILE, ContentHashes, MetadataStore, load_metadata, normalize_artist
+from metrics import Histogram, PrometheusText, RequestMetrics, RequestMetricsMiddleware, StageTimer, add_request_timing
+from profiler import StackSampler, collapsed
+from thumbnails import DEFAULT_FORMAT, DEFAULT_WIDTHS, FORMATS, THUMBNAIL_DIR, ThumbnailCache, parse_widths, pick_width, thumbnail_relpath
+from vector_store import RERANK_FILE, RerankStore
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -34,9 +51,101 @@ app.add_middleware(
 # Global variables for model and index
 model = None
 processor = None
-index = None
-metadata = None
 device = None
+image_encoder = None  # ImageEncoder running the vision tower with the configured backend
+startup_timings: Dict[str, float] = {}  # seconds per startup phase
+state = None  # IndexState currently being served; replaced as a whole on reload
+
+INDEX_DIR = Path(os.getenv("IMAGE_FINDER_INDEX_DIR", str(Path(__file__).parent / "subset_index")))
+# Memory-map index.faiss and the metadata columns so worker processes share them via the page cache
+INDEX_MMAP = os.getenv("IMAGE_FINDER_MMAP", "1") == "1"
+# Sharded indexes (build_index.py --index_shards): comma-separated shard names / numbers to serve (default all)
+INDEX_SHARDS = [name.strip() for name in os.getenv("IMAGE_FINDER_SHARDS", "").split(",") if name.strip()]
+# Read each shard on its first search instead of at load time
+INDEX_SHARDS_LAZY = os.getenv("IMAGE_FINDER_SHARDS_LAZY", "0") == "1"
+# Host the shards in N local worker processes, a stand-in for shard nodes (0 = search them in-process)
+INDEX_SHARD_PROCESSES = int(os.getenv("IMAGE_FINDER_SHARD_PROCESSES", "0"))
+# Exact reranking for compressed indexes built with --rerank (0 disables it)
+RERANK_ENABLED = os.getenv("IMAGE_FINDER_RERANK", "1") == "1"
+RERANK_FACTOR = os.getenv("IMAGE_FINDER_RERANK_FACTOR")  # overrides candidates_factor from index_config.json
+# Poll the index directory for rebuilt files every N seconds (0 = only reload via the admin endpoint)
+INDEX_WATCH_INTERVAL = float(os.getenv("IMAGE_FINDER_WATCH_INTERVAL", "0"))
+# Required by the /admin routes, which are disabled (403) while it is unset
+ADMIN_TOKEN = os.getenv("IMAGE_FINDER_ADMIN_TOKEN")
+
+# Micro-batching configuration (override via environment variables)
+BATCH_MAX_SIZE = int(os.getenv("IMAGE_FINDER_BATCH_MAX_SIZE", "16"))
+BATCH_WINDOW_MS = float(os.getenv("IMAGE_FINDER_BATCH_WINDOW_MS", "10"))
+
+MODEL_NAME = "openai/clip-vit-base-patch32"
+# Local vision-only artifact (build_index.py --export_vision); implies vision-only mode
+MODEL_ARTIFACT = os.getenv("IMAGE_FINDER_MODEL_ARTIFACT")
+# Load only the vision tower + projection (no text encoder, /search_text disabled)
+VISION_ONLY = os.getenv("IMAGE_FINDER_VISION_ONLY", "0") == "1" or bool(MODEL_ARTIFACT)
+# Image encoder backend: eager | int8 | bf16 | compile | torchscript | onnx (see encoders.py)
+ENCODER_BACKEND = os.getenv("IMAGE_FINDER_BACKEND", "eager")
+ENCODER_TOLERANCE = float(os.getenv("IMAGE_FINDER_BACKEND_TOLERANCE", "0.01"))  # max cosine distance from fp32
+
+# Upload limits and decode target
+MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_FINDER_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("IMAGE_FINDER_MAX_PIXELS", str(40_000_000)))
+MAX_BATCH_QUERIES = int(os.getenv("IMAGE_FINDER_MAX_BATCH_QUERIES", "32"))
+CLIP_INPUT_SIZE = 224
+MAX_TEXT_QUERY_CHARS = int(os.getenv("IMAGE_FINDER_MAX_TEXT_CHARS", "300"))
+
+# Multi-crop queries (/find_similar?multi_crop=true): the upload plus centered
+# zooms at these scales and four corner crops at MULTI_CROP_CORNER_SCALE (0 = none)
+MULTI_CROP_SCALES = [float(x) for x in os.getenv("IMAGE_FINDER_MULTI_CROP_SCALES", "0.8,0.6").split(",") if x.strip()]
+MULTI_CROP_CORNER_SCALE = float(os.getenv("IMAGE_FINDER_MULTI_CROP_CORNER_SCALE", "0.7"))
+MULTI_CROP_CANDIDATES = int(os.getenv("IMAGE_FINDER_MULTI_CROP_CANDIDATES", "4"))  # results per crop = this x top_k
+FUSION_METHODS = ("max", "mean", "rrf")
+RRF_K = 60  # reciprocal rank fusion constant (Cormack et al.)
+
+# Filtered search: candidate sets up to this size get an exact sub-index, larger
+# ones are searched through the main index with an ID selector
+FILTER_EXACT_MAX = int(os.getenv("IMAGE_FINDER_FILTER_EXACT_MAX", "20000"))
+# Index types whose search rejects an ID selector (IndexPQ); filtered sets always get a flat sub-index
+SELECTOR_UNSUPPORTED = ("pq",)
+FILTER_CACHE_SIZE = int(os.getenv("IMAGE_FINDER_FILTER_CACHE_SIZE", "64"))
+
+# Content-addressed caches for upload embeddings and search results
+CACHE_SIZE = int(os.getenv("IMAGE_FINDER_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.getenv("IMAGE_FINDER_CACHE_TTL", "3600"))  # seconds, 0 = never expire
+CACHE_DIR = os.getenv("IMAGE_FINDER_CACHE_DIR")  # optional on-disk tier for embeddings
+TEXT_CACHE_SIZE = int(os.getenv("IMAGE_FINDER_TEXT_CACHE_SIZE", "4096"))
+
+# /image: dataset images never change in place, so browsers may cache them for long
+IMAGE_MAX_AGE = int(os.getenv("IMAGE_FINDER_IMAGE_MAX_AGE", str(365 * 24 * 3600)))
+IMAGE_PATH_CACHE_SIZE = int(os.getenv("IMAGE_FINDER_IMAGE_PATH_CACHE_SIZE", "8192"))
+IMAGE_PATH_CACHE_TTL = float(os.getenv("IMAGE_FINDER_IMAGE_PATH_CACHE_TTL", "300"))
+# /image?size=: derivative widths (pre-generated by build_index.py --thumbnails) and the
+# size-capped directory that missing ones are rendered into on demand
+THUMBNAIL_WIDTHS = parse_widths(os.getenv("IMAGE_FINDER_THUMBNAIL_WIDTHS", ",".join(map(str, DEFAULT_WIDTHS))))
+THUMBNAIL_FORMAT = os.getenv("IMAGE_FINDER_THUMBNAIL_FORMAT", DEFAULT_FORMAT)
+THUMBNAIL_CACHE_DIR = Path(os.getenv("IMAGE_FINDER_THUMBNAIL_CACHE_DIR", str(Path(__file__).parent / "thumbnail_cache")))
+THUMBNAIL_CACHE_BYTES = int(os.getenv("IMAGE_FINDER_THUMBNAIL_CACHE_MB", "512")) * 1024 * 1024
+# Paths recorded in meta.json on the machine the subset index was built on
+OLD_IMAGE_BASE = "/Users/carolinezhang/Documents/GitHub/image_detector/subset500/subset_images/"
+IMAGE_BASE = Path(__file__).parent / "subset_images"
+
+# Worker pool for CPU-heavy steps (decoding, inference, FAISS search)
+WORKER_THREADS = int(os.getenv("IMAGE_FINDER_WORKERS", "2"))
+TORCH_THREADS = int(os.getenv("IMAGE_FINDER_TORCH_THREADS", "0"))  # 0 = split CPU cores across workers
+MAX_PENDING_JOBS = int(os.getenv("IMAGE_FINDER_MAX_PENDING", "64"))
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+# Instrumentation
+SLOW_REQUEST_MS = float(os.getenv("IMAGE_FINDER_SLOW_REQUEST_MS", "2000"))  # log requests slower than this, 0 = off
+PROFILE_MAX_SECONDS = float(os.getenv("IMAGE_FINDER_PROFILE_MAX_SECONDS", "60"))
+
+STARTED_AT = time.time()
+# Per-stage latency (upload read, decode, preprocess, forward, search, format, ...)
+stage_timer = StageTimer(LATENCY_BUCKETS)
+request_metrics = RequestMetrics(LATENCY_BUCKETS, slow_seconds=SLOW_REQUEST_MS / 1000)
+app.add_middleware(RequestMetricsMiddleware, metrics=request_metrics)
+stack_sampler = StackSampler()
 
 def pick_device():
     """Automatically select the best available device"""
@@ -49,81 +158,821 @@ def pick_device():
         pass
     return "cpu"
 
-def parse_artwork_title(filename: str) -> str:
+class LRUCache:
+    """Thread-safe LRU cache with an optional TTL and hit/miss counters"""
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry[1]):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Any, value: Any):
+        if self.max_size == 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._data), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses}
+
+class EmbeddingCache:
     """
-    Parse artwork filename to extract and format the title.
-    
-    Example: "jan-steen_return-of-the-prodigal-son-1670" -> "Return Of The Prodigal Son"
+    Upload content hash -> normalized embedding.
+
+    Backed by an in-memory LRU and, when `cache_dir` is set, a directory of
+    .npy files so embeddings survive restarts. Disk entries are namespaced by
+    model (name, or artifact path and file stats) and encoder backend, since
+    embeddings from different models or quantized backends are not interchangeable.
     """
-    try:
-        # Remove file extension
-        base_name = re.sub(r'\.(jpg|jpeg|png)$', '', filename, flags=re.IGNORECASE)
-        
-        # Split by underscore to separate artist and title-year
-        parts = base_name.split('_')
-        if len(parts) < 2:
-            return base_name.replace('-', ' ').title()
-        
-        # Get the title part (everything after the first underscore)
-        title_part = '_'.join(parts[1:])
-        
-        # Remove year at the end (4 digits)
-        title_part = re.sub(r'-\d{4}$', '', title_part)
-        
-        # Remove hash suffixes like _ae9c51ec
-        title_part = re.sub(r'_[a-f0-9]{8}$', '', title_part)
-        
-        # Remove trailing numbers that are not years
-        title_part = re.sub(r'-\d+$', '', title_part)
-        
-        # Convert to title case
-        title = title_part.replace('-', ' ').title()
-        
-        return title
-    except Exception as e:
-        logger.warning(f"Failed to parse artwork title from {filename}: {e}")
-        return filename.replace('-', ' ').title()
 
-def load_model_and_index():
-    """Load the CLIP model and FAISS index"""
-    global model, processor, index, metadata, device
+    def __init__(self, cache_dir: Optional[str] = CACHE_DIR):
+        self.memory = LRUCache()
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.disk_hits = 0
+        self._namespace: Optional[str] = None
+
+    def namespace(self) -> str:
+        """Directory name identifying the model and backend producing the embeddings"""
+        if self._namespace is not None:
+            return self._namespace
+        if MODEL_ARTIFACT:
+            artifact = Path(MODEL_ARTIFACT).resolve()
+            files = sorted((p.name, p.stat().st_mtime_ns, p.stat().st_size) for p in artifact.iterdir() if p.is_file())
+            digest = hashlib.sha256(repr((str(artifact), files)).encode()).hexdigest()[:16]
+            model_key = f"{artifact.name}-{digest}"
+        else:
+            model_key = MODEL_NAME.replace("/", "__")
+        # The backend actually in use: a rejected int8 / bf16 build falls back to eager
+        backend = image_encoder.backend if image_encoder is not None else ENCODER_BACKEND
+        namespace = f"{model_key}__{backend}"
+        if image_encoder is not None:
+            self._namespace = namespace
+        return namespace
+
+    def _disk_path(self, digest: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / self.namespace() / f"{digest}.npy"
+
+    def get(self, digest: str) -> Optional[np.ndarray]:
+        embedding = self.memory.get(digest)
+        if embedding is not None:
+            return embedding
+        path = self._disk_path(digest)
+        if path is None:
+            return None
+        try:
+            if CACHE_TTL > 0 and time.time() - path.stat().st_mtime > CACHE_TTL:
+                return None
+            embedding = np.load(path)
+        except (OSError, ValueError):
+            return None
+        self.disk_hits += 1
+        self.memory.put(digest, embedding)
+        return embedding
+
+    def put(self, digest: str, embedding: np.ndarray):
+        self.memory.put(digest, embedding)
+        path = self._disk_path(digest)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, embedding)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write embedding cache entry {path}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.memory.stats(), "disk_dir": str(self.cache_dir / self.namespace()) if self.cache_dir else None,
+                "disk_hits": self.disk_hits}
+
+embedding_cache = EmbeddingCache()
+# normalized text query -> embedding; no TTL since it only depends on the model
+text_embedding_cache = LRUCache(max_size=TEXT_CACHE_SIZE, ttl=0)
+# (index generation, content hash / "id:N" / "text:...", top_k, filters) -> response body
+result_cache = LRUCache()
+
+def load_index_config(index_dir: Path) -> Dict[str, Any]:
+    """Read the index sidecar config; indexes built before it existed are flat"""
+    config_path = index_dir / "index_config.json"
+    if not config_path.exists():
+        return {"index_type": "flat", "search_params": {}}
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def search_params_from_env(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Search parameters from the sidecar config; environment overrides allow re-tuning without rebuilding the index"""
+    search_params = dict(config.get("search_params", {}))
+    for name, env_var in (("nprobe", "IMAGE_FINDER_NPROBE"), ("efSearch", "IMAGE_FINDER_EF_SEARCH")):
+        if os.getenv(env_var):
+            search_params[name] = int(os.environ[env_var])
+    return search_params
+
+def configure_index(faiss_index, config: Dict[str, Any]):
+    """Apply search parameters (nprobe / efSearch) from the sidecar config and environment"""
+    search_params = apply_search_params(faiss_index, search_params_from_env(config), config.get("index_type"))
+    config["search_params"] = search_params
+    logger.info(f"Index type: {config.get('index_type', 'flat')}, search params: {search_params}")
+
+INDEX_FILES = ("index.faiss", "meta.json", "hashes.json", "index_config.json",
+               f"{COLUMNS_DIR}/{COLUMNS_FILE}", RERANK_FILE, f"{INDEX_SHARDS_DIR}/{SHARDS_MANIFEST}")
+
+class IndexState:
+    """
+    A loaded FAISS index (or `ShardedIndex`) together with everything derived from it.
+
+    Handlers take a local reference to the current state once per request, so
+    a reload can swap in a new state while in-flight requests finish against
+    the old one.
+    """
+
+    _generations = 0
+
+    def __init__(self, index_dir: Path, index, store: MetadataStore,
+                 content_hashes: ContentHashes, config: Dict[str, Any], fingerprint: tuple,
+                 rerank: Optional[RerankStore] = None):
+        IndexState._generations += 1
+        self.generation = IndexState._generations
+        self.index_dir = index_dir
+        self.index = index
+        self.store = store
+        self.content_hashes = content_hashes  # sha256 of an indexed image file -> index id
+        self.config = config  # index_config.json written by build_index.py
+        self.fingerprint = fingerprint
+        self.rerank = rerank  # exact vectors re-scoring coarse candidates of a compressed index
+        self.loaded_at = time.time()
+        self.load_seconds = 0.0
+        # filter key -> FilteredSubset, built on first use
+        self.subsets = LRUCache(max_size=FILTER_CACHE_SIZE, ttl=0)
+
+    @property
+    def sharded(self) -> bool:
+        return isinstance(self.index, ShardedIndex)
+
+    def vectors(self, ids) -> np.ndarray:
+        """Stored vectors of `ids`: exact from the rerank store if there is one, else reconstructed from the index"""
+        if self.rerank is not None:
+            return self.rerank.get(ids)
+        return self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def has_vector(self, item_id: int) -> bool:
+        """Whether `vectors` can return `item_id`; a partial shard set only holds its own shards' vectors"""
+        return self.rerank is not None or not self.sharded or self.index.serves(item_id)
+
+    def filtered_subset(self, filters: tuple) -> "FilteredSubset":
+        subset = self.subsets.get(filters)
+        if subset is None:
+            subset = FilteredSubset(self, self.store.filter_ids(*filters))
+            self.subsets.put(filters, subset)
+        return subset
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "generation": self.generation,
+            "index_dir": str(self.index_dir),
+            "index_size": self.index.ntotal,
+            "metadata": self.store.stats(),
+            "loaded_at": self.loaded_at,
+            "load_seconds": self.load_seconds,
+            "rerank_active": self.rerank is not None,
+            **({"shards": self.index.info()} if self.sharded else {}),
+            **self.config,
+        }
+
+def index_fingerprint(index_dir: Path) -> tuple:
+    """(name, mtime_ns, size) of every index file, used to detect rebuilt indexes"""
+    fingerprint = []
+    for name in INDEX_FILES:
+        try:
+            st = (index_dir / name).stat()
+            fingerprint.append((name, st.st_mtime_ns, st.st_size))
+        except OSError:
+            fingerprint.append((name, None, None))
+    return tuple(fingerprint)
+
+def read_faiss_index(index_path: Path):
+    """
+    Read index.faiss, memory-mapped read-only when enabled so the vectors /
+    inverted lists live in the shared page cache rather than each process heap.
+    Returns (index, whether it is actually memory-mapped).
+    """
+    return read_index_file(index_path, INDEX_MMAP)
+
+def load_rerank_store(index_dir: Path, config: Dict[str, Any]) -> Optional[RerankStore]:
+    """Memory-mapped rerank vectors of an index built with --rerank, if enabled"""
+    rerank = config.get("rerank")
+    if not rerank or not RERANK_ENABLED:
+        return None
+    path = index_dir / rerank.get("file", RERANK_FILE)
+    if not path.exists():
+        logger.warning(f"{path} is missing; serving coarse scores without reranking")
+        return None
+    if RERANK_FACTOR:
+        rerank["candidates_factor"] = int(RERANK_FACTOR)
+    store = RerankStore.open(path, rerank.get("candidates_factor", 4), mmap=INDEX_MMAP)
+    logger.info(f"Reranking {store.candidates_factor}x candidates against {path} "
+                f"({store.vectors.dtype}, {store.bytes_per_vector} bytes/vector)")
+    return store
+
+def load_sharded_index(index_dir: Path, manifest: Dict[str, Any], config: Dict[str, Any]) -> ShardedIndex:
+    """The shards listed in IMAGE_FINDER_SHARDS (by name or number), or all of them"""
+    names = None
+    if INDEX_SHARDS:
+        known = [e["name"] for e in manifest["shards"]]
+        names = [known[int(name)] if name.isdigit() and int(name) < len(known) else name for name in INDEX_SHARDS]
+        unknown = set(names) - set(known)
+        if unknown:
+            raise ValueError(f"Unknown index shards {sorted(unknown)} (available: {known})")
+    index_type = config.get("index_type", "flat")
+    search_params = search_params_from_env(config)
+    if not index_type.startswith("ivf"):
+        search_params.pop("nprobe", None)
+    if index_type != "hnsw":
+        search_params.pop("efSearch", None)
+    config["search_params"] = search_params
+    logger.info(f"Index type: {index_type} ({len(manifest['shards'])} shards), search params: {search_params}")
+    return ShardedIndex(index_dir, manifest, index_type, search_params, names=names,
+                        lazy=INDEX_SHARDS_LAZY, processes=INDEX_SHARD_PROCESSES, mmap=INDEX_MMAP)
+
+def load_index_state(index_dir: Path) -> IndexState:
+    """Load the FAISS index and metadata from `index_dir` without touching the served state"""
+    index_path = index_dir / "index.faiss"
+    meta_path = index_dir / "meta.json"
+    manifest = load_manifest(index_dir)
+    
+    if not (index_path.exists() or manifest) or not meta_path.exists():
+        raise FileNotFoundError(f"Index files not found in {index_dir}")
+    
+    t0 = time.perf_counter()
+    fingerprint = index_fingerprint(index_dir)
+    config = load_index_config(index_dir)
+    if manifest is not None:
+        faiss_index = load_sharded_index(index_dir, manifest, config)
+        index_mmapped = faiss_index.mmapped
+    else:
+        faiss_index, index_mmapped = read_faiss_index(index_path)
+        configure_index(faiss_index, config)
+    # Memory-mapped columns from build_index.py when available, else meta.json / hashes.json
+    store = load_metadata(index_dir, mmap=INDEX_MMAP)
+    rerank = load_rerank_store(index_dir, config)
+    
+    logger.info(f"Loaded index with {faiss_index.ntotal} vectors and {len(store)} metadata entries "
+                f"from {index_dir} (mmap: index={index_mmapped}, metadata={store.mmap})")
+    new_state = IndexState(index_dir, faiss_index, store, store.content_hashes, config, fingerprint, rerank)
+    new_state.load_seconds = time.perf_counter() - t0
+    return new_state
+
+def install_index_state(new_state: IndexState):
+    """Atomically make `new_state` the served index"""
+    global state
+    old_state, state = state, new_state
+    # Cached search results refer to the previous index's ids
+    result_cache.clear()
+    if old_state is not None:
+        logger.info(f"Swapped index generation {old_state.generation} -> {new_state.generation}")
+
+def load_model():
+    """Load the CLIP model, or only its vision tower in vision-only mode"""
+    global model, processor, device, image_encoder
     
     device = pick_device()
     logger.info(f"Using device: {device}")
     
-    # Load CLIP model
-    model_name = "openai/clip-vit-base-patch32"
-    logger.info(f"Loading CLIP model: {model_name}")
-    model = CLIPModel.from_pretrained(model_name).to(device).eval()
-    processor = CLIPProcessor.from_pretrained(model_name)
-    
-    # Load FAISS index and metadata
-    index_dir = Path(__file__).parent / "subset_index"
-    index_path = index_dir / "index.faiss"
-    meta_path = index_dir / "meta.json"
+    # transformers is slow to import, so it is only imported once a model is needed
+    if VISION_ONLY:
+        # Imported here (load_vision_model then reuses the module) so the import is its own phase
+        t0 = time.perf_counter()
+        from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection  # noqa: F401
+        startup_timings["import"] = time.perf_counter() - t0
+        
+        source = MODEL_ARTIFACT or MODEL_NAME
+        logger.info(f"Loading CLIP vision tower: {source}")
+        t0 = time.perf_counter()
+        model, processor = load_vision_model(source, device, local_only=bool(MODEL_ARTIFACT))
+        startup_timings["weights"] = time.perf_counter() - t0
+    else:
+        t0 = time.perf_counter()
+        from transformers import CLIPModel, CLIPProcessor
+        startup_timings["import"] = time.perf_counter() - t0
+        
+        logger.info(f"Loading CLIP model: {MODEL_NAME}")
+        t0 = time.perf_counter()
+        model = CLIPModel.from_pretrained(MODEL_NAME).to(device).eval()
+        processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+        startup_timings["weights"] = time.perf_counter() - t0
     
-    if not index_path.exists() or not meta_path.exists():
-        raise FileNotFoundError(f"Index files not found in {index_dir}")
+    t0 = time.perf_counter()
+    image_encoder = ImageEncoder(model, processor, backend=ENCODER_BACKEND, device=device,
+                                 tolerance=ENCODER_TOLERANCE, model_name=MODEL_NAME)
+    startup_timings["encoder"] = time.perf_counter() - t0
+
+def text_search_enabled() -> bool:
+    return model is not None and hasattr(model, "get_text_features")
+
+def load_model_and_index():
+    """Load the CLIP model and FAISS index, then warm up the image path"""
+    started = time.perf_counter()
+    load_model()
     
-    index = faiss.read_index(str(index_path))
-    with open(meta_path, 'r', encoding='utf-8') as f:
-        metadata = json.load(f)
+    t0 = time.perf_counter()
+    install_index_state(load_index_state(INDEX_DIR))
+    startup_timings["index"] = time.perf_counter() - t0
     
-    logger.info(f"Loaded index with {index.ntotal} vectors and {len(metadata)} metadata entries")
+    # The first forward pass pays for lazy initialization (kernels, allocator),
+    # so do it before the first request instead of during it
+    t0 = time.perf_counter()
+    get_image_embeddings([Image.new("RGB", (CLIP_INPUT_SIZE, CLIP_INPUT_SIZE))])
+    startup_timings["warmup"] = time.perf_counter() - t0
+    startup_timings["total"] = time.perf_counter() - started
+    logger.info("Startup timings: " + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in startup_timings.items()))
+
+reload_lock = asyncio.Lock()
+
+async def reload_index(index_dir: Optional[Path] = None) -> IndexState:
+    """Load an index in the background and swap it in; the model stays resident"""
+    async with reload_lock:
+        index_dir = index_dir or (state.index_dir if state else INDEX_DIR)
+        loop = asyncio.get_running_loop()
+        new_state = await loop.run_in_executor(None, load_index_state, index_dir)
+        install_index_state(new_state)
+        return new_state
+
+async def watch_index_dir():
+    """Reload when the index files change and have stayed unchanged for one poll interval"""
+    previous = None
+    while True:
+        await asyncio.sleep(INDEX_WATCH_INTERVAL)
+        current_state = state
+        if current_state is None:
+            continue
+        fingerprint = index_fingerprint(current_state.index_dir)
+        # Wait for a stable snapshot so a build that is still writing files is not picked up
+        if fingerprint != current_state.fingerprint and fingerprint == previous:
+            try:
+                await reload_index(current_state.index_dir)
+            except Exception as e:
+                logger.error(f"Automatic index reload failed: {e}")
+        previous = fingerprint
 
 def preprocess_image(image: Image.Image) -> Image.Image:
     """Preprocess image for CLIP model"""
     return ImageOps.exif_transpose(image.convert("RGB"))
 
+def decode_image_bytes(data: bytes, target_size: int = CLIP_INPUT_SIZE) -> Image.Image:
+    """
+    Decode an uploaded image from memory.
+
+    Only the header is parsed before the pixel guard, so oversized images are
+    rejected without being decoded. JPEGs are then decoded with DCT scaling
+    (1/2, 1/4 or 1/8) at the smallest size still covering CLIP's input.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image has too many pixels")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_IMAGE_PIXELS} pixels")
+
+    image.draft("RGB", (target_size, target_size))
+    return preprocess_image(image)
+
+def query_crops(image: Image.Image) -> List[Image.Image]:
+    """
+    The whole upload plus zoomed-in views, for photos (e.g. of a painting on a
+    museum wall) where the artwork fills only part of the frame
+    """
+    width, height = image.size
+    boxes = []
+    for scale in MULTI_CROP_SCALES:
+        w, h = round(width * scale), round(height * scale)
+        boxes.append(((width - w) // 2, (height - h) // 2, w, h))
+    if MULTI_CROP_CORNER_SCALE > 0:
+        w, h = round(width * MULTI_CROP_CORNER_SCALE), round(height * MULTI_CROP_CORNER_SCALE)
+        boxes.extend((left, top, w, h) for top in (0, height - h) for left in (0, width - w))
+    return [image] + [image.crop((left, top, left + w, top + h)) for left, top, w, h in boxes]
+
+def decode_query_crops(data: bytes) -> List[Image.Image]:
+    # Decode large enough that the smallest crop still covers CLIP's input
+    smallest = min(MULTI_CROP_SCALES + [MULTI_CROP_CORNER_SCALE or 1.0, 1.0])
+    return query_crops(decode_image_bytes(data, int(np.ceil(CLIP_INPUT_SIZE / smallest))))
+
 @torch.no_grad()
-def get_image_embedding(image: Image.Image) -> np.ndarray:
-    """Get CLIP embedding for an image"""
-    inputs = processor(images=image, return_tensors="pt").to(device)
-    features = model.get_image_features(**inputs)
+def get_image_embeddings(images: List[Image.Image]) -> np.ndarray:
+    """Get normalized CLIP embeddings for a batch of images in one forward pass"""
+    with stage_timer.time("preprocess"):
+        inputs = processor(images=images, return_tensors="pt").to(device)
+    with stage_timer.time("forward"):
+        features = image_encoder(inputs["pixel_values"])
     # Normalize the features
     features = torch.nn.functional.normalize(features, p=2, dim=1)
     return features.cpu().numpy().astype("float32")
 
+@torch.no_grad()
+def get_text_embeddings(texts: List[str]) -> np.ndarray:
+    """Get normalized CLIP text embeddings for a batch of queries in one forward pass"""
+    with stage_timer.time("tokenize"):
+        inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(device)
+    with stage_timer.time("text_forward"):
+        features = model.get_text_features(**inputs)
+    features = torch.nn.functional.normalize(features, p=2, dim=1)
+    return features.cpu().numpy().astype("float32")
+
+def get_image_embedding(image: Image.Image) -> np.ndarray:
+    """Get CLIP embedding for an image"""
+    return get_image_embeddings([image])
+
+def torch_thread_budget() -> int:
+    """Intra-op threads per worker so that all workers together use every core once"""
+    if TORCH_THREADS > 0:
+        return TORCH_THREADS
+    return max(1, (os.cpu_count() or 1) // max(1, WORKER_THREADS))
+
+class WorkerPool:
+    """
+    Bounded thread pool that all CPU-heavy work goes through.
+
+    Keeps the event loop free for cheap endpoints (/health, /image) while
+    embeddings and searches run. Jobs beyond `max_pending` (running + queued)
+    are rejected with a 503 instead of piling up unbounded latency.
+    """
+
+    def __init__(self, workers: int = WORKER_THREADS, max_pending: int = MAX_PENDING_JOBS):
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="image-finder-worker",
+            initializer=self._init_thread,
+        )
+        self._pending = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _init_thread():
+        torch.set_num_threads(torch_thread_budget())
+
+    def _timed(self, stage: str, fn: Callable, args: tuple):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - t0
+            stage_timer.observe(stage, elapsed, request=False)
+            logger.debug(f"[{stage}] {elapsed * 1000:.1f}ms")
+
+    async def run(self, stage: str, fn: Callable, *args) -> Any:
+        """Run `fn(*args)` on a worker thread, timing it under `stage`"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise HTTPException(status_code=503, detail="Server is busy, please retry shortly")
+            self._pending += 1
+        t0 = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._timed, stage, fn, args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            # The caller's view of the stage, including time queued for a worker
+            add_request_timing(stage, time.perf_counter() - t0)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending, rejected = self._pending, self._rejected
+        return {
+            "workers": self.workers,
+            "torch_threads": torch_thread_budget(),
+            "max_pending": self.max_pending,
+            "pending": pending,
+            "rejected": rejected,
+            "stage_seconds": stage_timer.snapshot(),
+        }
+
+worker_pool = WorkerPool()
+
+class MicroBatcher:
+    """
+    Collects concurrent requests and runs them through `batch_fn` together.
+
+    The first queued item opens a batch; the batch is closed once it holds
+    `max_batch_size` items or `window_ms` has elapsed. `batch_fn` receives the
+    list of items and must return one result per item, in order. Up to
+    `max_concurrent` batches run on the worker pool at the same time.
+    """
+
+    def __init__(self, name: str, batch_fn: Callable[[List[Any]], Any],
+                 max_batch_size: int = BATCH_MAX_SIZE, window_ms: float = BATCH_WINDOW_MS,
+                 max_concurrent: int = WORKER_THREADS):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_concurrent = max(1, max_concurrent)
+        self.batch_size_hist = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_hist = Histogram(LATENCY_BUCKETS)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight: set = set()
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Started {self.name} batcher (max_batch_size={self.max_batch_size}, window={self.window * 1000:.1f}ms)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item: Any) -> Any:
+        """Queue a single item and wait for its result"""
+        if self._queue is None:
+            raise RuntimeError(f"{self.name} batcher is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window * 1000,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size": self.batch_size_hist.snapshot(),
+            "queue_wait_seconds": self.queue_wait_hist.snapshot(),
+        }
+
+    async def _collect(self) -> List[tuple]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            now = time.perf_counter()
+            for _, _, enqueued_at in batch:
+                self.queue_wait_hist.observe(now - enqueued_at)
+            self.batch_size_hist.observe(len(batch))
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[tuple]):
+        items = [item for item, _, _ in batch]
+        try:
+            results = await worker_pool.run(self.name, self.batch_fn, items)
+        except Exception as e:
+            if not isinstance(e, HTTPException):
+                logger.error(f"{self.name} batch of {len(items)} failed: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+image_batcher = MicroBatcher("image", get_image_embeddings)
+text_batcher = MicroBatcher("text", get_text_embeddings)
+
+def filter_key(genre: Optional[str], artist: Optional[str],
+               year_min: Optional[int], year_max: Optional[int]) -> Optional[tuple]:
+    """Normalized (genre, artist, year_min, year_max) filter, None if nothing is filtered"""
+    if not genre and not artist and year_min is None and year_max is None:
+        return None
+    return (genre or None, normalize_artist(artist) if artist else None, year_min, year_max)
+
+class FilteredSubset:
+    """
+    The item ids matching one metadata filter, prepared for searching only them.
+
+    Small candidate sets are copied into an exact flat sub-index; larger ones
+    keep an ID selector that is passed into the main index search, except for
+    index types that cannot take a selector. A partial shard set only searches
+    the matching items of the shards it serves.
+    """
+
+    def __init__(self, s: IndexState, ids: np.ndarray):
+        if s.sharded:
+            ids = s.index.served_ids(ids)
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.exact = None
+        self.selector = None
+        if len(self.ids) <= FILTER_EXACT_MAX or s.config.get("index_type") in SELECTOR_UNSUPPORTED:
+            self.exact = self.flat_index(s)
+        else:
+            self.selector = faiss.IDSelectorBatch(len(self.ids), faiss.swig_ptr(self.ids))
+
+    def flat_index(self, s: IndexState):
+        flat = faiss.IndexFlat(s.index.d, s.index.metric_type)
+        if len(self.ids):
+            flat.add(s.vectors(self.ids))
+        return flat
+
+    def exact_index(self, s: IndexState):
+        """The flat sub-index, built once when a selector search falls short; later searches use it directly"""
+        if self.exact is None:
+            self.exact = self.flat_index(s)
+        return self.exact
+
+    def search_exact(self, flat, queries: np.ndarray, k: int):
+        scores, local = flat.search(queries, k)
+        if not len(self.ids):
+            return scores, local
+        return scores, np.where(local >= 0, self.ids[np.maximum(local, 0)], -1)
+
+def selector_search(s: IndexState, subset: FilteredSubset, queries: np.ndarray, k: int, exhaustive: bool = False):
+    """`index.search` restricted to `subset`; every shard of a sharded index applies the selector"""
+    if s.sharded:
+        return s.index.search(queries, k, selector=subset.selector, selector_ids=subset.ids, exhaustive=exhaustive)
+    params = selector_search_params(s.index, s.config.get("index_type"), subset.selector, exhaustive)
+    return s.index.search(queries, k, params=params)
+
+def filtered_search(s: IndexState, subset: FilteredSubset, queries: np.ndarray, k: int):
+    """Search the main index restricted to `subset` through its ID selector"""
+    try:
+        scores, indices = selector_search(s, subset, queries, k)
+    except RuntimeError as e:
+        # Index types without selector support are searched exactly over the candidates
+        logger.warning(f"Selector search failed ({e}); searching {len(subset.ids)} candidates exactly")
+        return subset.search_exact(subset.exact_index(s), queries, k)
+    expected = min(k, len(subset.ids))
+    if (indices >= 0).sum(axis=1).min() < expected:
+        # Approximate indexes can run out of matching candidates for narrow filters
+        if s.config.get("index_type", "flat").startswith("ivf"):
+            scores, indices = selector_search(s, subset, queries, k, exhaustive=True)
+        else:
+            scores, indices = subset.search_exact(subset.exact_index(s), queries, k)
+    return scores, indices
+
+def search_index(s: IndexState, queries: np.ndarray, k: int, filters: Optional[tuple] = None):
+    """
+    `index.search`, optionally restricted to the items matching `filters`.
+
+    The filter is applied inside the search rather than by over-fetching, so
+    every row has min(k, number of matching items) results. With a rerank
+    store the (compressed) index only supplies candidates, which are then
+    scored exactly.
+    """
+    subset = None
+    if filters is not None:
+        subset = s.filtered_subset(filters)
+        if subset.exact is not None:
+            return subset.search_exact(subset.exact, queries, k)
+    
+    coarse_k = k
+    if s.rerank is not None:
+        coarse_k = min(k * s.rerank.candidates_factor, max(k, s.index.ntotal))
+    if subset is None:
+        scores, indices = s.index.search(queries, coarse_k)
+    else:
+        scores, indices = filtered_search(s, subset, queries, coarse_k)
+    if s.rerank is not None:
+        return s.rerank.rerank(queries, indices, k)
+    return scores, indices
+
+def fuse_results(s: IndexState, queries: np.ndarray, scores: np.ndarray, indices: np.ndarray,
+                 k: int, fusion: str):
+    """
+    Merge the result lists of several query views into one ranking.
+
+    Every candidate is re-scored exactly against every view from the stored
+    vectors, so "max" and "mean" compare like with like even for candidates a
+    view did not return; "rrf" sums 1 / (RRF_K + rank) over the views' lists.
+    Returns (1, k) scores and ids like `index.search`; the scores are fused
+    similarities, or the best view's similarity for "rrf".
+    """
+    out_scores = np.full((1, k), -np.inf, dtype=np.float32)
+    out_ids = np.full((1, k), -1, dtype=np.int64)
+    candidates = np.unique(indices[indices >= 0])
+    if not len(candidates):
+        return out_scores, out_ids
+    
+    try:
+        sims = s.vectors(candidates) @ queries.T  # (candidates, views)
+    except RuntimeError:
+        # No reconstruction for this index: use the returned scores, a view's
+        # missing candidates counting as its weakest hit
+        sims = np.empty((len(candidates), len(queries)), dtype=np.float32)
+        for view in range(len(queries)):
+            hit = indices[view] >= 0
+            sims[:, view] = scores[view][hit].min() if hit.any() else -np.inf
+            sims[np.searchsorted(candidates, indices[view][hit]), view] = scores[view][hit]
+    
+    best = sims.max(axis=1)
+    if fusion == "max":
+        key = display = best
+    elif fusion == "mean":
+        key = display = sims.mean(axis=1)
+    else:
+        key, display = np.zeros(len(candidates)), best
+        for view in range(len(queries)):
+            hit = indices[view] >= 0
+            ranks = np.arange(1, hit.sum() + 1)
+            key[np.searchsorted(candidates, indices[view][hit])] += 1.0 / (RRF_K + ranks)
+    order = np.argsort(-key, kind="stable")[:k]
+    out_scores[0, :len(order)] = display[order]
+    out_ids[0, :len(order)] = candidates[order]
+    return out_scores, out_ids
+
+def search_fused(s: IndexState, queries: np.ndarray, k: int, filters: Optional[tuple], fusion: str):
+    """One multi-row search over all query views, fused into a single (1, k) result"""
+    per_view = max(k, k * MULTI_CROP_CANDIDATES)
+    scores, indices = search_index(s, queries, per_view, filters)
+    return fuse_results(s, queries, scores, indices, k, fusion)
+
+def build_similarity_response(store: MetadataStore, scores: np.ndarray,
+                              indices: np.ndarray, top_k: int) -> Dict[str, Any]:
+    """
+    Turn one row of `index.search` output into the /find_similar response body.
+
+    A first hit scoring >= 0.99 is treated as the query image itself: it is
+    reported as `input_image_info` and left out of `similar_images`.
+    """
+    has_perfect_match = len(scores) > 0 and scores[0] >= 0.99 and store.is_live(indices[0])
+    input_image_info = store.artwork(indices[0], scores[0]) if has_perfect_match else None
+    
+    results = []
+    for i, (score, idx) in enumerate(zip(scores, indices)):
+        if len(results) >= top_k:
+            break
+        if not store.is_live(idx):
+            continue
+        # Skip the first result if it's the perfect match (100% similarity)
+        if has_perfect_match and i == 0:
+            continue
+        results.append({"rank": len(results) + 1, **store.artwork(idx, score)})
+    
+    return {
+        "has_perfect_match": bool(has_perfect_match),
+        "input_image_info": input_image_info,
+        "similar_images": results,
+        "total_found": len(results)
+    }
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize model and index on startup"""
@@ -133,6 +982,22 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Failed to load model/index: {e}")
         raise
+    image_batcher.start()
+    text_batcher.start()
+    if INDEX_WATCH_INTERVAL > 0:
+        app.state.index_watcher = asyncio.create_task(watch_index_dir())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers"""
+    watcher = getattr(app.state, "index_watcher", None)
+    if watcher is not None:
+        watcher.cancel()
+    await image_batcher.stop()
+    await text_batcher.stop()
+    worker_pool.shutdown()
+    if state is not None and state.sharded:
+        state.index.close()
 
 @app.get("/")
 async def root():
@@ -140,153 +1005,557 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "index_size": index.ntotal if index else 0}
+    """
+    Readiness: 200 once the model and an index are loaded, else 503, with
+    what is loaded and how long loading took
+    """
+    s = state
+    ready = model is not None and image_encoder is not None and s is not None
+    return JSONResponse(status_code=200 if ready else 503, content={
+        "status": "healthy" if ready else "unavailable",
+        "ready": ready,
+        "model_loaded": model is not None,
+        "text_search": text_search_enabled(),
+        "index_loaded": s is not None,
+        "index_size": s.index.ntotal if s else 0,
+        "index_generation": s.generation if s else None,
+        "index_loaded_at": s.loaded_at if s else None,
+        "index_load_seconds": s.load_seconds if s else None,
+        "reloading": reload_lock.locked(),
+        "uptime_seconds": time.time() - STARTED_AT,
+        "startup": startup_timings,
+    })
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    caches = {"embeddings": embedding_cache.stats(), "text_embeddings": text_embedding_cache.stats(),
+              "results": result_cache.stats(), "image_paths": image_path_cache.stats(),
+              "thumbnails": thumbnail_cache.stats()}
+    if state is not None:
+        caches["filter_subsets"] = state.subsets.stats()
+    return caches
+
+@app.get("/stats")
+async def get_stats():
+    """Runtime statistics for tuning throughput against latency"""
+    return {
+        "batching": {"image": image_batcher.stats(), "text": text_batcher.stats()},
+        "workers": worker_pool.stats(),
+        "cache": cache_stats(),
+        "index": state.info() if state else None,
+        "encoder": image_encoder.info() if image_encoder else None,
+        "model": {"name": MODEL_ARTIFACT or MODEL_NAME, "vision_only": not text_search_enabled()},
+        "startup": startup_timings,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request, stage, queue and cache metrics in the Prometheus text exposition format"""
+    out = PrometheusText("image_finder")
+    out.counter("requests_total", "HTTP requests by route template and status",
+                request_metrics.requests.snapshot(), ("method", "route", "status"))
+    out.counter("request_errors_total", "HTTP requests answered with a 5xx status",
+                request_metrics.errors.snapshot(), ("route",))
+    out.gauge("requests_in_flight", "HTTP requests being handled", {(): request_metrics.in_flight})
+    out.histogram("request_duration_seconds", "HTTP request latency by route template",
+                  request_metrics.latency.snapshot(), ("route",))
+    out.histogram("stage_duration_seconds", "Time spent per processing stage",
+                  stage_timer.hists.snapshot(), ("stage",))
+    
+    pool = worker_pool.stats()
+    out.gauge("worker_threads", "Threads in the worker pool", {(): pool["workers"]})
+    out.gauge("worker_jobs_pending", "Worker pool jobs running or queued", {(): pool["pending"]})
+    out.counter("worker_jobs_rejected_total", "Jobs rejected with 503 because the worker pool was full",
+                {(): pool["rejected"]})
+    
+    batchers = {(b.name,): b for b in (image_batcher, text_batcher)}
+    out.gauge("batch_queue_depth", "Items waiting for a micro-batch",
+              {k: b.stats()["queue_depth"] for k, b in batchers.items()}, ("batcher",))
+    out.histogram("batch_size", "Items per micro-batch",
+                  {k: b.batch_size_hist.snapshot() for k, b in batchers.items()}, ("batcher",))
+    out.histogram("batch_queue_wait_seconds", "Time items waited for their micro-batch",
+                  {k: b.queue_wait_hist.snapshot() for k, b in batchers.items()}, ("batcher",))
+    
+    caches = cache_stats()
+    out.counter("cache_hits_total", "Cache hits", {(n,): c["hits"] for n, c in caches.items()}, ("cache",))
+    out.counter("cache_misses_total", "Cache misses", {(n,): c["misses"] for n, c in caches.items()}, ("cache",))
+    out.gauge("cache_entries", "Entries held per cache",
+              {(n,): c.get("size", c.get("files", 0)) for n, c in caches.items()}, ("cache",))
+    
+    s = state
+    out.gauge("ready", "1 once the model and an index are loaded",
+              {(): int(model is not None and s is not None)})
+    out.gauge("index_vectors", "Vectors in the served index", {(): s.index.ntotal if s else 0})
+    out.gauge("index_generation", "Generation of the served index, incremented per reload",
+              {(): s.generation if s else 0})
+    out.gauge("startup_seconds", "Duration of each startup phase",
+              {(phase,): seconds for phase, seconds in startup_timings.items()}, ("phase",))
+    out.gauge("profiler_running", "1 while a sampling profile is being recorded", {(): int(stack_sampler.running)})
+    return Response(out.render(), media_type=PrometheusText.CONTENT_TYPE)
+
+def check_admin_token(x_admin_token: Optional[str]):
+    """Fail closed: admin routes can swap the index or expose stacks, so they need a configured token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set IMAGE_FINDER_ADMIN_TOKEN")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile")
+async def admin_profile(seconds: float = 10.0, interval_ms: float = 5.0, include_idle: bool = False,
+                        x_admin_token: Optional[str] = Header(None)):
+    """
+    Sample the Python stacks of all server threads for `seconds` and return
+    them in collapsed-stack format (flamegraph.pl, speedscope). The stacks
+    include source paths, so this needs the admin token like the reload route.
+    """
+    check_admin_token(x_admin_token)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    try:
+        # Not on the worker pool: the profile must not take a slot from the work it observes
+        stacks = await asyncio.to_thread(stack_sampler.sample, seconds, interval_ms / 1000, include_idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(collapsed(stacks), media_type="text/plain",
+                    headers={"X-Profile-Samples": str(stack_sampler.last["samples"]),
+                             "X-Profile-Ticks": str(stack_sampler.last["ticks"])})
+
+@app.post("/admin/reload_index")
+async def admin_reload_index(index_dir: Optional[str] = None,
+                             x_admin_token: Optional[str] = Header(None)):
+    """
+    Load a (re)built index in the background and swap it in without a restart
+    """
+    check_admin_token(x_admin_token)
+    
+    if reload_lock.locked():
+        raise HTTPException(status_code=409, detail="An index reload is already in progress")
+    
+    try:
+        t0 = time.perf_counter()
+        new_state = await reload_index(Path(index_dir) if index_dir else None)
+        return {"status": "reloaded", "load_seconds": time.perf_counter() - t0, **new_state.info()}
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error reloading index: {e}")
+        raise HTTPException(status_code=500, detail=f"Error reloading index: {str(e)}")
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Read an uploaded image (one byte past the limit to detect oversized uploads)"""
+    image_data = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty upload")
+    return image_data
+
+def lookup_embedding(s: IndexState, digest: str, multi_crop: bool = False):
+    """
+    Embedding for an upload hash without running the model: the stored vector
+    if the file is already indexed, else the embedding cache (one row per
+    crop for `multi_crop`). Returns (embedding or None, item_id or None).
+    """
+    item_id = s.content_hashes.get(digest)
+    if item_id is not None and s.has_vector(item_id):
+        # Already indexed: reuse the stored vector, no decoding or inference
+        return s.vectors([item_id])[0], item_id
+    return embedding_cache.get(f"{digest}-crops" if multi_crop else digest), None
+
+def decode_many(datas: List[bytes]) -> List[Any]:
+    """Decode several uploads in one worker job; failures are returned in place as HTTPExceptions"""
+    images = []
+    for data in datas:
+        try:
+            images.append(decode_image_bytes(data))
+        except HTTPException as e:
+            images.append(e)
+    return images
 
 @app.post("/find_similar")
 async def find_similar_images(
     file: UploadFile = File(...),
-    top_k: int = 3
+    top_k: int = 3,
+    genre: Optional[str] = None,
+    artist: Optional[str] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+    multi_crop: bool = False,
+    fusion: str = "max"
 ) -> Dict[str, Any]:
     """
-    Find the most similar images to the uploaded image
+    Find the most similar images to the uploaded image, optionally only among
+    artworks of a genre, an artist and/or a year range.
+    
+    With `multi_crop`, the upload and several zoomed-in crops of it are
+    embedded in one forward pass, searched together and their results fused
+    per artwork with `fusion` ("max", "mean" or "rrf"); this helps with
+    photos that include frames, walls or glare.
     """
-    if not model or not index or not metadata:
+    s = state
+    if not model or not s:
         raise HTTPException(status_code=500, detail="Model or index not loaded")
     
     if top_k <= 0 or top_k > 10:
         raise HTTPException(status_code=400, detail="top_k must be between 1 and 10")
+    if fusion not in FUSION_METHODS:
+        raise HTTPException(status_code=400, detail=f"fusion must be one of {', '.join(FUSION_METHODS)}")
+    filters = filter_key(genre, artist, year_min, year_max)
     
     try:
-        # Read and process the uploaded image
-        image_data = await file.read()
+        with stage_timer.time("read_upload"):
+            image_data = await read_upload(file)
         
-        # Create a temporary file to save the image
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_file:
-            tmp_file.write(image_data)
-            tmp_path = tmp_file.name
+        # Identical uploads (demo images, retries) are served from the caches
+        with stage_timer.time("cache_lookup"):
+            digest = hashlib.sha256(image_data).hexdigest()
+            result_key = (s.generation, f"{fusion}-crops:{digest}" if multi_crop else digest, top_k, filters)
+            cached_response = result_cache.get(result_key)
+            if cached_response is None:
+                embedding, item_id = lookup_embedding(s, digest, multi_crop)
+        if cached_response is not None:
+            return {**cached_response, "query_image": file.filename}
         
-        try:
-            # Load and preprocess the image
-            image = Image.open(tmp_path)
-            image = preprocess_image(image)
-            
-            # Get embedding
-            query_embedding = get_image_embedding(image)
-            
-            # Search for similar images - if we expect a perfect match, search for more results
-            search_k = top_k + 1 if top_k >= 3 else top_k  # Search for one extra result if we might skip the first one
-            scores, indices = index.search(query_embedding, search_k)
-            
-            # Check if we have a perfect match (similarity score >= 0.99)
-            has_perfect_match = False
-            input_image_info = None
-            
-            if len(scores[0]) > 0 and scores[0][0] >= 0.99:
-                has_perfect_match = True
-                # Get the perfect match info
-                idx = indices[0][0]
-                if idx < len(metadata):
-                    image_path = metadata[idx]["image_path"]
-                    filename = Path(image_path).name
-                    parsed_title = parse_artwork_title(filename)
-                    
-                    input_image_info = {
-                        "title": parsed_title,
-                        "artist": metadata[idx]["artist"],
-                        "genre": metadata[idx]["genre"],
-                        "image_path": metadata[idx]["image_path"],
-                        "similarity_score": float(scores[0][0])
-                    }
-            
-            # Prepare results
-            results = []
-            if has_perfect_match:
-                # If we have a perfect match, show similar images but skip the first 100% match
-                for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                    if idx < len(metadata) and len(results) < top_k:
-                        # Skip the first result if it's the perfect match (100% similarity)
-                        if i == 0 and score >= 0.99:
-                            continue
-                            
-                        # Parse the title from the filename
-                        image_path = metadata[idx]["image_path"]
-                        filename = Path(image_path).name
-                        parsed_title = parse_artwork_title(filename)
-                        
-                        result = {
-                            "rank": len(results) + 1,  # Adjust rank to start from 1
-                            "similarity_score": float(score),
-                            "title": parsed_title,
-                            "artist": metadata[idx]["artist"],
-                            "genre": metadata[idx]["genre"],
-                            "image_path": metadata[idx]["image_path"]
-                        }
-                        results.append(result)
-            else:
-                # If no perfect match, show only the most similar images (excluding the input image)
-                for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                    if idx < len(metadata) and len(results) < top_k:
-                        # Parse the title from the filename
-                        image_path = metadata[idx]["image_path"]
-                        filename = Path(image_path).name
-                        parsed_title = parse_artwork_title(filename)
-                        
-                        result = {
-                            "rank": i + 1,
-                            "similarity_score": float(score),
-                            "title": parsed_title,
-                            "artist": metadata[idx]["artist"],
-                            "genre": metadata[idx]["genre"],
-                            "image_path": metadata[idx]["image_path"]
-                        }
-                        results.append(result)
-            
-            return {
-                "query_image": file.filename,
-                "has_perfect_match": has_perfect_match,
-                "input_image_info": input_image_info,
-                "similar_images": results,
-                "total_found": len(results)
-            }
-            
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_path)
+        if embedding is None and multi_crop:
+            crops = await worker_pool.run("decode", decode_query_crops, image_data)
+            # All crops in one forward pass, rather than one request each
+            embedding = await worker_pool.run("embed", get_image_embeddings, crops)
+            embedding_cache.put(f"{digest}-crops", embedding)
+        elif embedding is None:
+            # Decode straight from memory at (close to) CLIP's input resolution
+            image = await worker_pool.run("decode", decode_image_bytes, image_data)
             
+            # Get embedding (batched with concurrent requests)
+            with stage_timer.time("embed"):
+                embedding = await image_batcher.submit(image)
+            embedding_cache.put(digest, embedding)
+        query_embedding = embedding.reshape(-1, embedding.shape[-1])
+        
+        # Search for similar images - if we expect a perfect match, search for more results
+        expect_self = top_k >= 3 or item_id is not None
+        search_k = top_k + 1 if expect_self else top_k  # Search for one extra result if we might skip the first one
+        if len(query_embedding) > 1:
+            scores, indices = await worker_pool.run("search", search_fused, s, query_embedding, search_k,
+                                                    filters, fusion)
+        else:
+            scores, indices = await worker_pool.run("search", search_index, s, query_embedding, search_k, filters)
+        
+        with stage_timer.time("format"):
+            response = {"query_image": file.filename,
+                        **build_similarity_response(s.store, scores[0], indices[0], top_k)}
+            if len(query_embedding) > 1:
+                response["query_crops"] = len(query_embedding)
+                response["fusion"] = fusion
+        result_cache.put(result_key, response)
+        return response
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
-@app.get("/image/{image_path:path}")
-async def serve_image(image_path: str):
+@app.get("/find_similar/by_id/{item_id}")
+async def find_similar_by_id(item_id: int, top_k: int = 3,
+                             genre: Optional[str] = None, artist: Optional[str] = None,
+                             year_min: Optional[int] = None, year_max: Optional[int] = None) -> Dict[str, Any]:
     """
-    Serve images from the dataset
+    Find the most similar images to an artwork that is already in the index
     """
+    s = state
+    if not s:
+        raise HTTPException(status_code=500, detail="Index not loaded")
+    
+    if top_k <= 0 or top_k > 10:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 10")
+    
+    # Ids of removed artworks stay as null entries in meta.json
+    if not s.store.is_live(item_id):
+        raise HTTPException(status_code=404, detail=f"Unknown item id: {item_id}")
+    
+    if not s.has_vector(item_id):
+        raise HTTPException(status_code=404, detail=f"Item {item_id} is in an index shard this server does not serve")
+    
+    filters = filter_key(genre, artist, year_min, year_max)
+    cached_response = result_cache.get((s.generation, f"id:{item_id}", top_k, filters))
+    if cached_response is not None:
+        return cached_response
+    
     try:
-        # Decode base64 path if needed
-        if image_path.startswith("b64:"):
-            decoded_path = base64.b64decode(image_path[4:]).decode("utf-8")
-        else:
-            decoded_path = image_path
+        with stage_timer.time("vector_lookup"):
+            query_embedding = s.vectors([item_id])
+        # The item itself comes back first, so fetch one extra neighbour
+        scores, indices = await worker_pool.run("search", search_index, s, query_embedding, top_k + 1, filters)
+        with stage_timer.time("format"):
+            response = {
+                "query_image": s.store.raw_titles[item_id],
+                "item_id": item_id,
+                **build_similarity_response(s.store, scores[0], indices[0], top_k)
+            }
+        result_cache.put((s.generation, f"id:{item_id}", top_k, filters), response)
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error searching by item id {item_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error searching by item id: {str(e)}")
+
+@app.post("/find_similar/batch")
+async def find_similar_batch(
+    files: List[UploadFile] = File(default=[]),
+    item_ids: List[int] = Query(default=[]),
+    top_k: int = 3,
+    genre: Optional[str] = None,
+    artist: Optional[str] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Find similar images for several uploads and/or indexed item ids at once.
+    
+    All uploads that need inference are embedded in one batched forward pass
+    and every query is answered by a single multi-row index search. Each
+    entry of `results` has the same shape as a /find_similar response, or an
+    `error` if that query could not be processed. Filters apply to every query.
+    Results list the `item_ids` queries in order, then the uploads in order;
+    each is keyed by its `item_id`, or by `upload_index` and `filename`.
+    """
+    s = state
+    if not model or not s:
+        raise HTTPException(status_code=500, detail="Model or index not loaded")
+    
+    if top_k <= 0 or top_k > 10:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 10")
+    
+    n_queries = len(files) + len(item_ids)
+    if n_queries == 0:
+        raise HTTPException(status_code=400, detail="Provide at least one file or item_id")
+    if n_queries > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    
+    try:
+        # One slot per query, keyed by item_id or upload_index: name, embedding (filled below) and error
+        queries = []
+        for item_id in item_ids:
+            if not s.store.is_live(item_id):
+                queries.append({"query_image": str(item_id), "item_id": item_id, "error": f"Unknown item id: {item_id}"})
+            elif not s.has_vector(item_id):
+                queries.append({"query_image": s.store.raw_titles[item_id], "item_id": item_id,
+                                "error": f"Item {item_id} is in an index shard this server does not serve"})
+            else:
+                queries.append({"query_image": s.store.raw_titles[item_id], "item_id": item_id,
+                                "embedding": s.vectors([item_id])[0]})
         
-        # Convert old path to new path
-        old_base = "/Users/carolinezhang/Documents/GitHub/image_detector/subset500/subset_images/"
-        new_base = str(Path(__file__).parent / "subset_images")
+        to_embed = []  # (query, digest, bytes) for uploads needing inference
+        for upload_index, file in enumerate(files):
+            query = {"query_image": file.filename, "upload_index": upload_index, "filename": file.filename}
+            queries.append(query)
+            try:
+                with stage_timer.time("read_upload"):
+                    image_data = await read_upload(file)
+            except HTTPException as e:
+                query["error"] = e.detail
+                continue
+            with stage_timer.time("cache_lookup"):
+                digest = hashlib.sha256(image_data).hexdigest()
+                query["embedding"], _ = lookup_embedding(s, digest)
+            if query["embedding"] is None:
+                to_embed.append((query, digest, image_data))
         
-        if decoded_path.startswith(old_base):
-            # Extract the relative path from the old base
-            relative_path = decoded_path[len(old_base):]
-            full_path = Path(new_base) / relative_path
-        else:
-            full_path = Path(decoded_path)
+        if to_embed:
+            decoded = await worker_pool.run("decode", decode_many, [data for _, _, data in to_embed])
+            ready = []
+            for (query, digest, _), image in zip(to_embed, decoded):
+                if isinstance(image, HTTPException):
+                    query["error"] = image.detail
+                else:
+                    ready.append((query, digest, image))
+            if ready:
+                embeddings = await worker_pool.run("embed", get_image_embeddings, [image for _, _, image in ready])
+                for (query, digest, _), embedding in zip(ready, embeddings):
+                    query["embedding"] = embedding
+                    embedding_cache.put(digest, embedding)
         
-        if not full_path.exists():
-            logger.warning(f"Image not found: {full_path}")
-            raise HTTPException(status_code=404, detail="Image not found")
+        searchable = [q for q in queries if "embedding" in q and "error" not in q]
+        if searchable:
+            query_matrix = np.stack([q.pop("embedding") for q in searchable]).astype("float32")
+            # One extra neighbour per row since a query may match itself
+            scores, indices = await worker_pool.run("search", search_index, s, query_matrix, top_k + 1,
+                                                    filter_key(genre, artist, year_min, year_max))
+            with stage_timer.time("format"):
+                for row, query in enumerate(searchable):
+                    query.update(build_similarity_response(s.store, scores[row], indices[row], top_k))
+        for query in queries:
+            query.pop("embedding", None)
         
-        from fastapi.responses import FileResponse
-        return FileResponse(str(full_path))
+        return {"results": queries, "total_queries": len(queries)}
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing batch: {str(e)}")
+
+def normalize_text_query(text: str) -> str:
+    """CLIP's tokenizer lowercases and ignores extra whitespace, so these queries embed identically"""
+    return " ".join(text.split()).lower()
+
+@app.get("/search_text")
+async def search_text(
+    q: str,
+    top_k: int = 3,
+    genre: Optional[str] = None,
+    artist: Optional[str] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Find the artworks that best match a free-text description, e.g. "stormy seascape at night"
+    """
+    s = state
+    if not model or not s:
+        raise HTTPException(status_code=500, detail="Model or index not loaded")
+    if not text_search_enabled():
+        raise HTTPException(status_code=501, detail="Text search is unavailable in vision-only mode")
+    
+    if top_k <= 0 or top_k > 10:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 10")
+    
+    query = normalize_text_query(q)
+    if not query:
+        raise HTTPException(status_code=400, detail="Empty query")
+    if len(query) > MAX_TEXT_QUERY_CHARS:
+        raise HTTPException(status_code=400, detail=f"Query exceeds {MAX_TEXT_QUERY_CHARS} characters")
+    filters = filter_key(genre, artist, year_min, year_max)
+    
+    cached_response = result_cache.get((s.generation, f"text:{query}", top_k, filters))
+    if cached_response is not None:
+        return {**cached_response, "query_text": q}
+    
+    try:
+        embedding = text_embedding_cache.get(query)
+        if embedding is None:
+            # Batched with concurrent text queries
+            with stage_timer.time("embed_text"):
+                embedding = await text_batcher.submit(query)
+            text_embedding_cache.put(query, embedding)
+        
+        scores, indices = await worker_pool.run("search", search_index, s, embedding.reshape(1, -1), top_k, filters)
+        with stage_timer.time("format"):
+            response = {"query_text": q, **build_similarity_response(s.store, scores[0], indices[0], top_k)}
+        result_cache.put((s.generation, f"text:{query}", top_k, filters), response)
+        return response
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error searching text query {q!r}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error searching text: {str(e)}")
+
+# /image path as requested -> (meta.json path, resolved file path, os.stat_result);
+# (path, width) -> pre-generated thumbnail file
+image_path_cache = LRUCache(max_size=IMAGE_PATH_CACHE_SIZE, ttl=IMAGE_PATH_CACHE_TTL)
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_BYTES, THUMBNAIL_FORMAT)
+
+def resolve_image_path(image_path: str):
+    """
+    Map an /image path to (decoded path, file on disk, stat result), or None
+    if there is no such file. Successful lookups are cached, so repeated
+    requests for the same image skip decoding, path rewriting and the stat.
+    """
+    cached = image_path_cache.get(image_path)
+    if cached is not None:
+        return cached
+    
+    # Decode base64 path if needed
+    if image_path.startswith("b64:"):
+        decoded_path = base64.b64decode(image_path[4:]).decode("utf-8")
+    else:
+        decoded_path = image_path
+    
+    # Convert old path to new path
+    if decoded_path.startswith(OLD_IMAGE_BASE):
+        full_path = IMAGE_BASE / decoded_path[len(OLD_IMAGE_BASE):]
+    else:
+        full_path = Path(decoded_path)
+    
+    try:
+        stat_result = os.stat(full_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    resolved = (decoded_path, str(full_path), stat_result)
+    image_path_cache.put(image_path, resolved)
+    return resolved
+
+async def thumbnail_file(image_path: str, source_key: str, source: str,
+                         stat_result: os.stat_result, width: int) -> Union[str, bytes]:
+    """
+    Path of the pre-generated derivative from the index build, else the
+    contents of one from (or rendered into) the on-demand cache
+    """
+    # The mtime is part of the key so a replaced source is not served its old derivative
+    path_key = (image_path, width, stat_result.st_mtime_ns)
+    prebuilt = image_path_cache.get(path_key)
+    if prebuilt is not None:
+        return prebuilt
+    rel = thumbnail_relpath(source_key, stat_result, width, THUMBNAIL_FORMAT)
+    s = state
+    if s is not None and (s.index_dir / THUMBNAIL_DIR / rel).is_file():
+        prebuilt = str(s.index_dir / THUMBNAIL_DIR / rel)
+        image_path_cache.put(path_key, prebuilt)
+        return prebuilt
+    cached = await asyncio.to_thread(thumbnail_cache.get, rel)
+    if cached is not None:
+        return cached
+    return await worker_pool.run("thumbnail", thumbnail_cache.create, source, rel, width)
+
+@app.get("/image/{image_path:path}")
+async def serve_image(image_path: str,
+                      size: Optional[int] = None,
+                      if_none_match: Optional[str] = Header(None),
+                      if_modified_since: Optional[str] = Header(None)):
+    """
+    Serve images from the dataset, with validators and long-lived caching headers.
+    With `size`, serve the derivative whose width is nearest above it.
+    """
+    if size is not None and size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    try:
+        with stage_timer.time("resolve_path"):
+            resolved = resolve_image_path(image_path)
+    except ValueError as e:  # malformed base64 / UTF-8
+        raise HTTPException(status_code=400, detail=f"Invalid image path: {e}")
+    if resolved is None:
+        logger.warning(f"Image not found: {image_path}")
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    source_key, full_path, stat_result = resolved
+    width = pick_width(size, THUMBNAIL_WIDTHS) if size is not None and THUMBNAIL_WIDTHS else None
+    headers = {
+        "ETag": image_etag(stat_result, width),
+        "Last-Modified": email.utils.formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": f"public, max-age={IMAGE_MAX_AGE}, immutable",
+    }
+    if is_not_modified(headers["ETag"], stat_result.st_mtime, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+    
+    if width is not None:
+        try:
+            with stage_timer.time("thumbnail_lookup"):
+                thumbnail = await thumbnail_file(image_path, source_key, full_path, stat_result, width)
+            if isinstance(thumbnail, bytes):
+                return Response(thumbnail, headers=headers, media_type=FORMATS[THUMBNAIL_FORMAT][1])
+            return FileResponse(thumbnail, headers=headers, media_type=FORMATS[THUMBNAIL_FORMAT][1])
+        except HTTPException:
+            raise
+        except Exception as e:
+            # The original is still a correct answer, just a larger one
+            logger.warning(f"Failed to produce {width}px thumbnail of {full_path}: {e}")
+    
+    try:
+        return FileResponse(full_path, headers=headers, stat_result=stat_result)
     except Exception as e:
         logger.error(f"Error serving image: {e}")
         raise HTTPException(status_code=500, detail="Error serving image")
@@ -296,6 +1565,10 @@ async def get_style_artworks(style_name: str, count: int = 3):
     """
     Get random artworks from a specific style
     """
+    s = state
+    if not s:
+        raise HTTPException(status_code=500, detail="Index not loaded")
+    
     try:
         import random
         
@@ -316,55 +1589,38 @@ async def get_style_artworks(style_name: str, count: int = 3):
         # Normalize style name for response
         normalized_style_name = style_name.title() if style_name.lower() in ['impressionism', 'cubism'] else style_name
         
-        # Find artworks with the specified style
-        style_artworks = []
-        for item in metadata:
-            if genre_to_search in item.get('genre', ''):
-                style_artworks.append(item)
+        # Artworks whose genre list is exactly this style, from the inverted index
+        with stage_timer.time("style_lookup"):
+            style_ids = s.store.ids_with_genre_string(genre_to_search)
         
-        if not style_artworks:
+        if len(style_ids) == 0:
             raise HTTPException(status_code=404, detail=f"No artworks found for style: {style_name}")
         
         # Randomly select the requested number of artworks
-        selected_artworks = random.sample(style_artworks, min(count, len(style_artworks)))
+        selected = random.sample(range(len(style_ids)), min(count, len(style_ids)))
         
-        # Format the response
+        # Set appropriate source based on style
+        source = f"{style_name} Collection"
+        
+        # Format the response from the pre-parsed cards
         result = []
-        for artwork in selected_artworks:
-            # Parse the artwork info from the title
-            title_parts = artwork['title'].split('_')
-            if len(title_parts) >= 2:
-                artist = title_parts[0].replace('-', ' ').title()
-                title = title_parts[1].replace('-', ' ').title()
-                
-                # Extract year if present
-                year = ""
-                if len(title_parts) > 2:
-                    year_part = title_parts[2]
-                    # Look for 4-digit year
-                    year_match = re.search(r'\b(1[0-9]{3}|2[0-9]{3})\b', year_part)
-                    if year_match:
-                        year = year_match.group(1)
-                
-                # Set appropriate source based on style
-                source = f"{style_name} Collection"
-                if style_name.lower() in ['impressionism', 'high renaissance']:
-                    source = f"{style_name} Collection"
-                elif style_name.lower() in ['cubism', 'contemporary-art']:
-                    source = f"{style_name} Collection"
-                
-                result.append({
-                    'id': artwork['title'],
-                    'title': title,
-                    'artist': artist,
-                    'year': year,
-                    'style': normalized_style_name,
-                    'url': f"/image/{artwork['image_path']}",
-                    'source': source,
-                    'description': f"A masterpiece from the {normalized_style_name} period by {artist}",
-                    'styleLabels': [normalized_style_name, artist],
-                    'similarity': 1.0
-                })
+        for position in selected:
+            idx = int(style_ids[position])
+            card = s.store.style_card(idx)
+            if card is None:
+                continue
+            result.append({
+                'id': s.store.raw_titles[idx],
+                'title': card['title'],
+                'artist': card['artist'],
+                'year': card['year'],
+                'style': normalized_style_name,
+                'url': f"/image/{s.store.image_paths[idx]}",
+                'source': source,
+                'description': f"A masterpiece from the {normalized_style_name} period by {card['artist']}",
+                'styleLabels': [normalized_style_name, card['artist']],
+                'similarity': 1.0
+            })
         
         return JSONResponse(content={
             'artworks': result,
@@ -372,6 +1628,8 @@ async def get_style_artworks(style_name: str, count: int = 3):
             'count': len(result)
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting style artworks: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting style artworks: {str(e)}")
@@ -0,0 +1,416 @@
+"""
+Offline benchmarks for the image_finder service and index builder.
+
+Everything runs against generated data: a randomly initialised CLIP vision
+tower (same architecture as ViT-B/32) saved as a local artifact, synthetic
+JPEGs, and random clustered vectors, so no downloads or real catalogue are
+needed and runs on different machines or commits are comparable. It measures
+
+- build:     build_index.py images/sec for each --build_workers setting
+- embedding: image embedding latency per batch size (preprocessing + forward)
+- search:    FAISS search latency and recall@k by index type and size
+- e2e:       POST /find_similar throughput and latency at N concurrent
+             clients, through the ASGI app in-process (no sockets)
+
+and writes the results as JSON. With --baseline, headline metrics are compared
+against an earlier result file and the run fails on regressions.
+
+    python benchmark.py --out bench.json
+    python benchmark.py --out new.json --baseline bench.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("benchmark")
+
+ARTISTS = ("claude monet", "rembrandt", "vincent van gogh", "gerard sekoto", "pablo picasso",
+           "katsushika hokusai", "frida kahlo", "paul cezanne")
+GENRES = ("['Impressionism']", "['Baroque']", "['Expressionism', 'Realism']", "['Cubism']",
+          "['Ukiyo-e']", "['Post-Impressionism']")
+
+# section -> (fields identifying a row, {metric: +1 if higher is better, -1 if lower is better})
+HEADLINE_METRICS = {
+    "build": (("processes",), {"images_per_s": 1}),
+    "embedding": (("batch_size",), {"images_per_s": 1}),
+    "search": (("index_type", "n"), {"latency_ms.p50": -1, "batch_qps": 1}),
+    "e2e": (("clients", "cache"), {"requests_per_s": 1, "latency_ms.p95": -1}),
+}
+
+def parse_list(value: str, cast=int) -> List[Any]:
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """Latency distribution in milliseconds"""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {}
+    return {"mean": float(ms.mean()), "p50": float(np.percentile(ms, 50)),
+            "p95": float(np.percentile(ms, 95)), "p99": float(np.percentile(ms, 99)),
+            "max": float(ms.max())}
+
+# ---------- synthetic data ----------
+
+def synthetic_image(rng: np.random.Generator, width: int, height: int) -> Image.Image:
+    """Smooth colour gradients plus noise, so JPEG sizes and decode cost resemble photos of paintings"""
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    a, b, c = rng.uniform(0, 255, (3, 3)).astype(np.float32)
+    base = a * (1 - x) * (1 - y) + b * x + c * y * (1 - x)
+    noise = rng.normal(0, rng.uniform(5, 30), (height, width, 3)).astype(np.float32)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+def synthetic_jpeg(rng: np.random.Generator, width: int, height: int, quality: int = 90) -> bytes:
+    buf = io.BytesIO()
+    synthetic_image(rng, width, height).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+def write_catalogue(root: Path, n: int, size: Tuple[int, int], seed: int = 0) -> Path:
+    """n synthetic artworks as JPEGs plus a build_index.py metadata CSV"""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    image_dir = root / "images"
+    image_dir.mkdir(parents=True, exist_ok=True)
+    rows = []
+    for i in range(n):
+        artist = ARTISTS[i % len(ARTISTS)]
+        title = f"{artist.replace(' ', '-')}_synthetic-study-{i}-{1850 + i % 150}"
+        path = image_dir / f"{title}.jpg"
+        path.write_bytes(synthetic_jpeg(rng, *size))
+        rows.append({"image_path": str(path), "artist": artist,
+                     "genre": GENRES[i % len(GENRES)], "title": title})
+    meta_csv = root / "metadata.csv"
+    pd.DataFrame(rows).to_csv(meta_csv, index=False)
+    return meta_csv
+
+def write_model_artifact(out_dir: Path, seed: int = 0):
+    """Randomly initialised CLIP vision tower + projection in the layout of `export_vision_model`"""
+    import torch
+    from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+
+    torch.manual_seed(seed)
+    model = CLIPVisionModelWithProjection(CLIPVisionConfig(projection_dim=512)).eval()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(out_dir, safe_serialization=True)
+    CLIPImageProcessor().save_pretrained(out_dir)
+
+def clustered_vectors(rng: np.random.Generator, n: int, d: int, clusters: int = 256) -> np.ndarray:
+    """Unit vectors around random centroids, closer to real embeddings than uniform noise"""
+    centroids = rng.normal(size=(clusters, d)).astype(np.float32)
+    x = centroids[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, d)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+# ---------- in-process ASGI client ----------
+
+async def asgi_request(asgi_app, method: str, path: str, query: str = "",
+                       headers: Tuple[Tuple[str, str], ...] = (), body: bytes = b"") -> Tuple[int, bytes]:
+    """One HTTP request straight into an ASGI app; returns (status, body)"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "client": ("127.0.0.1", 0), "server": ("benchmark", 80),
+    }
+    request_sent = False
+    response_done = asyncio.Event()
+    status, chunks = 0, []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                response_done.set()
+
+    await asgi_app(scope, receive, send)
+    return status, b"".join(chunks)
+
+def multipart_file(field: str, filename: str, data: bytes, content_type: str = "image/jpeg") -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n").encode()
+    return head + data + f"\r\n--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+# ---------- benchmarks ----------
+
+def bench_build(model_dir: Path, meta_csv: Path, n: int, work_dir: Path, processes_list: List[int],
+                batch: int, decode_workers: int, device: Optional[str]) -> Tuple[List[Dict[str, Any]], Path]:
+    """Full index builds of the synthetic catalogue; returns the results and the last index dir"""
+    from build_index import CLIPIndexer, IndexSpec
+
+    indexer = CLIPIndexer(model_name=str(model_dir), device=device, local_only=True, vision_only=True)
+    results, index_dir = [], None
+    for processes in processes_list:
+        # A fresh dir each time, otherwise the embedding checkpoints would be reused
+        index_dir = work_dir / f"index_p{processes}"
+        t0 = time.perf_counter()
+        indexer.build_and_save(meta_csv, index_dir, batch=batch, spec=IndexSpec("flat"),
+                               workers=decode_workers, processes=processes)
+        seconds = time.perf_counter() - t0
+        results.append({"processes": processes, "decode_threads": decode_workers, "batch": batch,
+                        "images": n, "seconds": seconds, "images_per_s": n / seconds})
+        logger.info(f"build: processes={processes} {n / seconds:.1f} images/s")
+    return results, index_dir
+
+def bench_embedding(service, batch_sizes: List[int], repeats: int, image_size: Tuple[int, int],
+                    seed: int = 1) -> List[Dict[str, Any]]:
+    """`get_image_embeddings` (CLIP preprocessing + encoder) per batch size"""
+    rng = np.random.default_rng(seed)
+    images = [synthetic_image(rng, *image_size) for _ in range(max(batch_sizes))]
+    results = []
+    for batch_size in batch_sizes:
+        batch = images[:batch_size]
+        service.get_image_embeddings(batch)  # warm-up for this shape
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            service.get_image_embeddings(batch)
+            times.append(time.perf_counter() - t0)
+        latency = summarize(times)
+        results.append({"batch_size": batch_size, "repeats": repeats, "latency_ms": latency,
+                        "images_per_s": batch_size * 1000 / latency["p50"]})
+        logger.info(f"embedding: batch={batch_size} {latency['p50']:.1f} ms/batch")
+    return results
+
+def bench_search(sizes: List[int], index_types: List[str], dim: int, queries: int, k: int,
+                 seed: int = 2) -> List[Dict[str, Any]]:
+    """Single-query latency, batched throughput and recall@k per index type and size"""
+    import faiss
+    from build_index import IndexSpec, finalize_index
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in sizes:
+        x = clustered_vectors(rng, n, dim)
+        q = clustered_vectors(rng, queries, dim)
+        truth = np.argsort(-(q @ x.T), axis=1)[:, :k]
+        for index_type in index_types:
+            spec = IndexSpec(index_type=index_type, seed=seed)
+            t0 = time.perf_counter()
+            index = spec.wrap_ids(spec.build(dim, n))
+            if not index.is_trained:
+                index.train(x[spec.training_rows(n)])
+            index.add_with_ids(x, np.arange(n, dtype="int64"))
+            finalize_index(index, spec)
+            build_s = time.perf_counter() - t0
+
+            times = []
+            for row in q:
+                t0 = time.perf_counter()
+                index.search(row[None, :], k)
+                times.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            _, got = index.search(q, k)
+            batch_s = time.perf_counter() - t0
+            recall = sum(len(set(g) & set(t)) for g, t in zip(got, truth)) / (k * queries)
+            latency = summarize(times)
+            results.append({"index_type": index_type, "n": n, "dim": dim, "k": k, "queries": queries,
+                            "search_params": spec.search_params(), "build_s": build_s,
+                            "latency_ms": latency, "batch_qps": queries / batch_s,
+                            f"recall@{k}": recall, "faiss_threads": faiss.omp_get_max_threads()})
+            logger.info(f"search: {index_type} n={n} {latency['p50']:.3f} ms/query, recall@{k}={recall:.3f}")
+    return results
+
+async def run_clients(asgi_app, uploads: List[Tuple[bytes, str]], clients: int, top_k: int) -> Dict[str, Any]:
+    """`clients` concurrent request loops draining `uploads` through POST /find_similar"""
+    todo = iter(uploads)
+    latencies, statuses = [], Counter()
+
+    async def client():
+        for body, content_type in todo:  # shared iterator: each upload is sent once
+            t0 = time.perf_counter()
+            status, _ = await asgi_request(asgi_app, "POST", "/find_similar", f"top_k={top_k}",
+                                           (("content-type", content_type),
+                                            ("content-length", str(len(body)))), body)
+            latencies.append(time.perf_counter() - t0)
+            statuses[str(status)] += 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    wall = time.perf_counter() - t0
+    return {"requests": len(latencies), "seconds": wall, "requests_per_s": len(latencies) / wall,
+            "latency_ms": summarize(latencies), "status": dict(statuses)}
+
+async def bench_e2e(service, clients_list: List[int], requests: int, top_k: int,
+                    image_size: Tuple[int, int], seed: int = 3) -> List[Dict[str, Any]]:
+    """
+    /find_similar at each client count: first with uploads the service has
+    never seen (decode + embedding + search), then replaying them (cache hits)
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for clients in clients_list:
+        uploads = [multipart_file("file", f"query_{i}.jpg", synthetic_jpeg(rng, *image_size))
+                   for i in range(requests)]
+        for cache in ("cold", "cached"):
+            row = await run_clients(service.app, uploads, clients, top_k)
+            results.append({"clients": clients, "cache": cache, "top_k": top_k, **row})
+            logger.info(f"e2e: clients={clients} {cache} {row['requests_per_s']:.1f} req/s, "
+                        f"p95 {row['latency_ms']['p95']:.1f} ms, status {row['status']}")
+    return results
+
+# ---------- reporting ----------
+
+def environment_info() -> Dict[str, Any]:
+    info = {"python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "numpy": np.__version__}
+    for name in ("torch", "faiss", "transformers"):
+        try:
+            info[name] = __import__(name).__version__
+        except Exception:
+            info[name] = None
+    try:
+        info["git_commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                                            capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        info["git_commit"] = None
+    return info
+
+def metric(row: Dict[str, Any], name: str) -> Optional[float]:
+    value: Any = row
+    for part in name.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def compare_runs(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Headline metrics that got worse than the baseline by more than `tolerance` (relative)"""
+    regressions = []
+    for section, (key_fields, metrics) in HEADLINE_METRICS.items():
+        before = {tuple(r.get(f) for f in key_fields): r for r in baseline.get(section, [])}
+        for row in current.get(section, []):
+            key = tuple(row.get(f) for f in key_fields)
+            old = before.get(key)
+            if old is None:
+                continue
+            for name, direction in metrics.items():
+                new_value, old_value = metric(row, name), metric(old, name)
+                if not new_value or not old_value:
+                    continue
+                change = (new_value - old_value) / old_value * direction
+                if change < -tolerance:
+                    label = ", ".join(f"{f}={v}" for f, v in zip(key_fields, key))
+                    regressions.append(f"{section} [{label}] {name}: {old_value:.4g} -> {new_value:.4g} "
+                                       f"({change:+.1%})")
+    return regressions
+
+async def run_service(service, args, results: Dict[str, Any]):
+    """Start the app (lifespan events included) and run the service-side benchmarks"""
+    await service.app.router.startup()
+    try:
+        results["startup"] = dict(service.startup_timings)
+        if "embedding" in args.sections:
+            results["embedding"] = await asyncio.to_thread(
+                bench_embedding, service, parse_list(args.batch_sizes), args.repeats, args.image_size)
+        if "e2e" in args.sections:
+            results["e2e"] = await bench_e2e(service, parse_list(args.clients), args.requests,
+                                             args.top_k, args.query_size)
+    finally:
+        await service.app.router.shutdown()
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--out", default="benchmark_results.json", help="result JSON file")
+    ap.add_argument("--baseline", default=None, help="earlier result JSON to check for regressions")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="relative slowdown counted as a regression")
+    ap.add_argument("--sections", default="embedding,search,e2e",
+                    help="comma-separated subset of embedding,search,e2e (the build always runs: it makes the served index)")
+    ap.add_argument("--work_dir", default=None, help="where to put generated data (default: a temp dir)")
+    ap.add_argument("--device", default=None, help="force device for the build: cuda | mps | cpu")
+    ap.add_argument("--build_images", type=int, default=128, help="synthetic catalogue size")
+    ap.add_argument("--build_workers", default="0,4", help="--workers settings to build with (0 = thread decoding)")
+    ap.add_argument("--decode_workers", type=int, default=4)
+    ap.add_argument("--batch", type=int, default=16, help="build embedding batch size")
+    ap.add_argument("--batch_sizes", default="1,4,16,32", help="embedding batch sizes")
+    ap.add_argument("--repeats", type=int, default=10, help="timed embedding runs per batch size")
+    ap.add_argument("--index_sizes", default="10000,100000", help="vectors per synthetic search index")
+    ap.add_argument("--index_types", default="flat,sq8,ivf_flat,hnsw")
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--queries", type=int, default=200, help="search queries per index")
+    ap.add_argument("--top_k", type=int, default=10)
+    ap.add_argument("--clients", default="1,4,16", help="concurrent /find_similar clients")
+    ap.add_argument("--requests", type=int, default=100, help="uploads per client setting")
+    args = ap.parse_args()
+    args.sections = set(parse_list(args.sections, str))
+    args.image_size = (1024, 768)   # catalogue / embedding inputs
+    args.query_size = (640, 480)    # uploads
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    tmp = None
+    if args.work_dir:
+        work_dir = Path(args.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix="image_finder_bench_")
+        work_dir = Path(tmp.name)
+
+    results: Dict[str, Any] = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "args": {k: v if not isinstance(v, set) else sorted(v) for k, v in vars(args).items()},
+    }
+    try:
+        model_dir = work_dir / "model"
+        write_model_artifact(model_dir)
+        meta_csv = write_catalogue(work_dir / "catalogue", args.build_images, args.image_size)
+        results["build"], index_dir = bench_build(model_dir, meta_csv, args.build_images, work_dir,
+                                                  parse_list(args.build_workers), args.batch,
+                                                  args.decode_workers, args.device)
+
+        if "search" in args.sections:
+            results["search"] = bench_search(parse_list(args.index_sizes), parse_list(args.index_types, str),
+                                             args.dim, args.queries, args.top_k)
+
+        if args.sections & {"embedding", "e2e"}:
+            # app.py reads its configuration at import time
+            os.environ["IMAGE_FINDER_INDEX_DIR"] = str(index_dir)
+            os.environ["IMAGE_FINDER_MODEL_ARTIFACT"] = str(model_dir)
+            os.environ.setdefault("IMAGE_FINDER_THUMBNAIL_CACHE_DIR", str(work_dir / "thumbnail_cache"))
+            import app as service
+            asyncio.run(run_service(service, args, results))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    out = Path(args.out)
+    out.write_text(json.dumps(results, indent=2))
+    logger.info(f"Wrote {out}")
+
+    if args.baseline:
+        regressions = compare_runs(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in regressions:
+            logger.warning(f"regression: {line}")
+        if regressions:
+            sys.exit(1)
+        logger.info(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
-import json, os, sys, threading, time
+import hashlib, io, json, os, shutil, sys, threading, time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 import pandas as pd
 import numpy as np
 from PIL import Image, ImageOps
 from tqdm import tqdm
 import torch, faiss
-from transformers import CLIPProcessor, CLIPModel
 import logging
 
+from encoders import BACKENDS, ImageEncoder, export_vision_model, load_vision_model
+from index_shards import INDEX_SHARDS_DIR, SHARDS_FORMAT, SHARDS_MANIFEST, SHARD_BY
+from metadata_store import write_metadata_columns
+from thumbnails import DEFAULT_FORMAT, DEFAULT_WIDTHS, FORMATS, THUMBNAIL_DIR, make_thumbnails, parse_widths, prune_thumbnails, thumbnail_relpath
+from vector_store import RERANK_DTYPES, RERANK_FILE, RerankStore, write_rerank_store
+
 
 def setup_logger(log_file: Path, verbose: bool = True):
     log_file.parent.mkdir(parents=True, exist_ok=True)
@@ -29,6 +37,110 @@ def exif_open(p: Path):
     return ImageOps.exif_transpose(img)
 
 
+# First line of a Git LFS pointer file, left in place of the image when `git lfs pull` was not run
+LFS_POINTER_PREFIX = b"version https://git-lfs.github.com/spec/v1"
+
+
+class LFSPointerError(RuntimeError):
+    pass
+
+
+def read_image_bytes(p: Path) -> bytes:
+    """Raw bytes of an image file; fails on Git LFS pointer stubs so they are never embedded or hashed."""
+    data = p.read_bytes()
+    if data.startswith(LFS_POINTER_PREFIX):
+        raise LFSPointerError(f"{p} is a Git LFS pointer, not an image; run `git lfs pull` first")
+    return data
+
+
+def read_image(p: Path):
+    """Open an image and hash its raw bytes from a single read of the file."""
+    data = read_image_bytes(p)
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    return ImageOps.exif_transpose(img), hashlib.sha256(data).hexdigest()
+
+
+class ClipPreprocess:
+    """CLIP image preprocessing (shortest-edge resize, center crop, rescale, normalize) in PIL + numpy.
+
+    Parameters are copied from the loaded (CLIP)ImageProcessor, so the pixels
+    match `proc(images=...)`; the object is picklable and needs no
+    transformers import, so loader processes can run it.
+    """
+
+    def __init__(self, proc):
+        ip = getattr(proc, "image_processor", proc)
+        size = ip.size
+        self.shortest_edge = int(size.get("shortest_edge") or min(size["height"], size["width"]))
+        self.crop = (int(ip.crop_size["height"]), int(ip.crop_size["width"]))
+        self.rescale = float(ip.rescale_factor)
+        self.mean = np.asarray(ip.image_mean, dtype=np.float32).reshape(3, 1, 1)
+        self.std = np.asarray(ip.image_std, dtype=np.float32).reshape(3, 1, 1)
+        self.resample = int(ip.resample)
+
+    def __call__(self, img: Image.Image) -> np.ndarray:
+        """RGB image -> (3, crop_h, crop_w) float32"""
+        w, h = img.size
+        s = self.shortest_edge
+        nw, nh = (s, int(s * h / w)) if w <= h else (int(s * w / h), s)
+        img = img.resize((nw, nh), resample=self.resample)
+        ch, cw = self.crop
+        top, left = (nh - ch) // 2, (nw - cw) // 2
+        img = img.crop((left, top, left + cw, top + ch))
+        x = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) * self.rescale
+        return (x - self.mean) / self.std
+
+
+def load_preprocessed(item, preprocess: ClipPreprocess):
+    """Loader-process work for one (row_id, image_path): (pixels, sha256, file_key).
+
+    JPEGs are decoded at the smallest DCT scale still covering the resize
+    target, so full-resolution scans are never decoded in full.
+    """
+    _, p = item
+    p = Path(p)
+    key = file_key(p)
+    data = read_image_bytes(p)
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (preprocess.shortest_edge, preprocess.shortest_edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return preprocess(img), hashlib.sha256(data).hexdigest(), key
+
+
+def save_content_hashes(hashes, index_dir: Path):
+    """hashes.json: sha256 of each indexed file -> its id, so the API can skip re-embedding it."""
+    with open(index_dir / "hashes.json", "w", encoding="utf-8") as f:
+        json.dump({"algorithm": "sha256", "items": hashes}, f)
+    logging.info(f"[OK] saved {len(hashes)} content hashes to {index_dir / 'hashes.json'}")
+
+
+def backfill_content_hashes(index_dir: Path, path_map=None):
+    """Write hashes.json for an existing index without re-embedding anything.
+
+    path_map: optional (old_prefix, new_prefix) to relocate image_path entries
+    that were recorded on another machine.
+    """
+    with open(index_dir / "meta.json", "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    hashes, missing = {}, 0
+    for i, m in enumerate(tqdm(meta, desc="Hashing images", mininterval=0.5)):
+        if m is None:  # removed id
+            continue
+        p = m["image_path"]
+        if path_map and p.startswith(path_map[0]):
+            p = path_map[1] + p[len(path_map[0]):]
+        try:
+            hashes.setdefault(hashlib.sha256(read_image_bytes(Path(p))).hexdigest(), i)
+        except OSError as e:
+            missing += 1
+            logging.warning(f"[skip] {p}: {e}")
+    logging.info(f"Hashed {len(hashes)} images, missing {missing}")
+    save_content_hashes(hashes, index_dir)
+    write_metadata_columns(index_dir)
+
+
 def pick_device(cli_device: str | None):
     if cli_device:
         return cli_device
@@ -51,8 +163,8 @@ class Heartbeat:
         self._th = threading.Thread(target=self._run, daemon=True)
 
     def _run(self):
-        while not self._stop.is_set():
-            time.sleep(self.interval)
+        # wait() returns as soon as stop() is called, so stopping costs no sleep interval
+        while not self._stop.wait(self.interval):
             logging.info("... still working (heartbeat) ...")
 
     def start(self):
@@ -63,8 +175,586 @@ class Heartbeat:
         self._th.join(timeout=1)
 
 
+SHARD_TEMPLATE = "trained.faiss"  # empty trained index the shards are cloned from
+INDEX_TYPES = ("flat", "fp16", "sq8", "pq", "ivf_flat", "ivf_pq", "hnsw")
+
+
+class IndexSpec:
+    """Which FAISS index to build and how the API should search it.
+
+    Written next to index.faiss as index_config.json; app.py applies
+    `search_params` (nprobe / efSearch) when it loads the index. With `rerank`
+    ("fp16" / "fp32") a full-precision copy of the vectors is written as
+    rerank_vectors.npy and the API re-scores `rerank_factor` x top_k coarse
+    candidates from the (compressed) index against it. With `shards` > 1 the
+    vectors are split by id range or genre (`shard_by`) into that many indexes
+    under index_shards/ instead of one index.faiss.
+    """
+    def __init__(self, index_type="flat", nlist=None, nprobe=16, pq_m=64, pq_nbits=8,
+                 hnsw_m=32, ef_construction=200, ef_search=64, train_size=None, seed=0,
+                 rerank=None, rerank_factor=4, shards=0, shard_by="range"):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {INDEX_TYPES}, got {index_type!r}")
+        if rerank is not None and rerank not in RERANK_DTYPES:
+            raise ValueError(f"rerank must be one of {tuple(RERANK_DTYPES)}, got {rerank!r}")
+        if shard_by not in SHARD_BY:
+            raise ValueError(f"shard_by must be one of {SHARD_BY}, got {shard_by!r}")
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.train_size = train_size
+        self.seed = seed
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        self.shards = shards if shards > 1 else 0
+        self.shard_by = shard_by
+
+    @classmethod
+    def from_config(cls, config):
+        """Rebuild the spec of an existing index from its index_config.json."""
+        b, sp = config.get("build_params", {}), config.get("search_params", {})
+        rr = config.get("rerank") or {}
+        sh = config.get("sharding") or {}
+        return cls(index_type=config["index_type"], nlist=b.get("nlist"), pq_m=b.get("pq_m", 64),
+                   pq_nbits=b.get("pq_nbits", 8), hnsw_m=b.get("M", 32),
+                   ef_construction=b.get("efConstruction", 200),
+                   nprobe=sp.get("nprobe", 16), ef_search=sp.get("efSearch", 64),
+                   rerank=rr.get("dtype"), rerank_factor=rr.get("candidates_factor", 4),
+                   shards=sh.get("shards", 0), shard_by=sh.get("by", "range"))
+
+    @property
+    def is_ivf(self):
+        return self.index_type.startswith("ivf")
+
+    def wrap_ids(self, index):
+        """IVF indexes keep explicit ids natively; others get an IndexIDMap2 so ids survive removals."""
+        return index if self.is_ivf else faiss.IndexIDMap2(index)
+
+    def resolve_nlist(self, n):
+        # faiss wants ~39+ training points per centroid; 4*sqrt(n) is the usual starting point
+        nlist = self.nlist or int(4 * np.sqrt(n))
+        return max(1, min(nlist, n // 39 if n >= 39 else 1))
+
+    @property
+    def uses_pq(self):
+        return self.index_type in ("pq", "ivf_pq")
+
+    def check_pq(self, d):
+        if self.uses_pq and d % self.pq_m:
+            raise ValueError(f"pq_m={self.pq_m} must divide the embedding dimension {d}")
+
+    def build(self, d, n):
+        if self.index_type == "flat":
+            return faiss.IndexFlatIP(d)
+        if self.index_type in ("fp16", "sq8"):
+            qtype = faiss.ScalarQuantizer.QT_fp16 if self.index_type == "fp16" else faiss.ScalarQuantizer.QT_8bit
+            return faiss.IndexScalarQuantizer(d, qtype, faiss.METRIC_INNER_PRODUCT)
+        if self.index_type == "pq":
+            self.check_pq(d)
+            return faiss.IndexPQ(d, self.pq_m, self.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(d, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.ef_construction
+            return index
+        self.nlist = self.resolve_nlist(n)
+        quantizer = faiss.IndexFlatIP(d)
+        if self.index_type == "ivf_flat":
+            return faiss.IndexIVFFlat(quantizer, d, self.nlist, faiss.METRIC_INNER_PRODUCT)
+        self.check_pq(d)
+        return faiss.IndexIVFPQ(quantizer, d, self.nlist, self.pq_m, self.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+
+    def training_rows(self, n):
+        """Uniform random subset of row ids for k-means / PQ / SQ training (all rows if n is small)."""
+        pq_min = 2 ** self.pq_nbits * 39 if self.uses_pq else 0
+        if self.is_ivf:
+            want = max(256 * self.nlist, pq_min)
+        else:
+            # PQ codebooks; scalar quantizer value ranges need far fewer
+            want = pq_min or 65536
+        want = self.train_size or want
+        if want >= n:
+            return list(range(n))
+        rng = np.random.default_rng(self.seed)
+        return sorted(rng.choice(n, size=want, replace=False).tolist())
+
+    def search_params(self):
+        if self.is_ivf:
+            return {"nprobe": min(self.nprobe, self.nlist or self.nprobe)}
+        if self.index_type == "hnsw":
+            return {"efSearch": self.ef_search}
+        return {}
+
+    def apply_search_params(self, index, params=None):
+        if isinstance(index, faiss.IndexIDMap):
+            index = faiss.downcast_index(index.index)
+        ps = faiss.ParameterSpace()
+        for name, value in (params or self.search_params()).items():
+            ps.set_index_parameter(index, name, value)
+
+    def to_config(self, d, ntotal):
+        build_params = {"nlist": self.nlist, "pq_m": self.pq_m, "pq_nbits": self.pq_nbits} if self.is_ivf else {}
+        if self.index_type == "pq":
+            build_params = {"pq_m": self.pq_m, "pq_nbits": self.pq_nbits}
+        if self.index_type == "hnsw":
+            build_params = {"M": self.hnsw_m, "efConstruction": self.ef_construction}
+        config = {
+            "index_type": self.index_type,
+            "metric": "inner_product",
+            "dim": int(d),
+            "ntotal": int(ntotal),
+            "build_params": build_params,
+            "search_params": self.search_params(),
+        }
+        if self.rerank:
+            config["rerank"] = {"dtype": self.rerank, "file": RERANK_FILE, "candidates_factor": self.rerank_factor}
+        if self.shards:
+            config["sharding"] = {"shards": self.shards, "by": self.shard_by,
+                                  "manifest": f"{INDEX_SHARDS_DIR}/{SHARDS_MANIFEST}"}
+        return config
+
+
+def finalize_index(index, spec: IndexSpec):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        # lets the API reconstruct stored vectors (by-id search, hash short-circuit)
+        # and, unlike an array map, allows remove_ids / non-contiguous ids
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    spec.apply_search_params(index)
+    return index
+
+
+def prefetch(fn, items, workers=4, depth=64, processes=False):
+    """Ordered parallel map with at most `depth` results in flight.
+
+    Yields (item, result, error) in input order, so a slow consumer (the
+    embedding loop) caps how far decoding runs ahead and memory stays bounded.
+    With `processes`, `fn` and the items must be picklable.
+    """
+    items = iter(items)
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+    with executor as ex:
+        pending = deque()
+        for item in items:
+            pending.append((item, ex.submit(fn, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, fut = pending.popleft()
+            try:
+                yield item, fut.result(), None
+            except Exception as e:
+                yield item, None, e
+            nxt = next(items, None)
+            if nxt is not None:
+                pending.append((nxt, ex.submit(fn, nxt)))
+
+
+def index_bytes_per_vector(index):
+    """Serialized size of `index` per stored vector (codes plus ids, inverted lists, graph links)."""
+    return faiss.serialize_index(index).nbytes / max(1, index.ntotal)
+
+
+def evaluate_recall(index, exact, queries, spec: IndexSpec, k=10):
+    """recall@k, per-query latency and memory per vector of `index` against `exact`, a flat index over the same ids.
+
+    For IVF / HNSW the search parameter is swept so a setting can be picked
+    from the numbers. With spec.rerank every setting is also measured with
+    exact reranking of rerank_factor * k candidates.
+    """
+    k = min(k, exact.ntotal)
+    rerank = None
+    if spec.rerank:
+        vectors = exact.reconstruct_n(0, exact.ntotal).astype(RERANK_DTYPES[spec.rerank])
+        rerank = RerankStore(vectors, spec.rerank_factor)
+    t0 = time.perf_counter()
+    _, truth = exact.search(queries, k)
+    flat_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+
+    if spec.is_ivf:
+        sweep = [{"nprobe": p} for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p <= spec.nlist]
+    elif spec.index_type == "hnsw":
+        sweep = [{"efSearch": e} for e in (16, 32, 64, 128, 256, 512) if e >= k]
+    else:
+        sweep = [{}]
+
+    def recall(got, kk):
+        return sum(len(set(g[:kk]) & set(t[:kk])) for g, t in zip(got, truth)) / (kk * len(queries))
+
+    rows = []
+    for params in sweep:
+        spec.apply_search_params(index, params)
+        t0 = time.perf_counter()
+        _, got = index.search(queries, k)
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        row = {"params": params, "latency_ms_per_query": ms}
+        for kk in sorted({1, k}):
+            row[f"recall@{kk}"] = recall(got, kk)
+        msg = f"  {params or spec.index_type}: recall@{k}={row[f'recall@{k}']:.4f}  {ms:.3f} ms/query"
+        if rerank is not None:
+            t0 = time.perf_counter()
+            _, candidates = index.search(queries, min(k * rerank.candidates_factor, index.ntotal))
+            _, got = rerank.rerank(queries, candidates, k)
+            ms = (time.perf_counter() - t0) * 1000 / len(queries)
+            row["latency_ms_per_query_reranked"] = ms
+            for kk in sorted({1, k}):
+                row[f"recall@{kk}_reranked"] = recall(got, kk)
+            msg += f" | reranked: recall@{k}={row[f'recall@{k}_reranked']:.4f}  {ms:.3f} ms/query"
+        rows.append(row)
+        logging.info(msg)
+    spec.apply_search_params(index)
+
+    memory = {"index": index_bytes_per_vector(index), "flat_fp32": 4 * exact.d,
+              "rerank_store": rerank.bytes_per_vector if rerank is not None else 0}
+    logging.info(f"  bytes/vector: index={memory['index']:.1f} (flat fp32 {memory['flat_fp32']}), "
+                 f"rerank store={memory['rerank_store']} (memory-mapped)")
+    return {
+        "index_type": spec.index_type,
+        "rerank": spec.rerank,
+        "ntotal": int(exact.ntotal),
+        "n_queries": int(len(queries)),
+        "k": k,
+        "bytes_per_vector": memory,
+        "flat_latency_ms_per_query": flat_ms,
+        "results": rows,
+    }
+
+
+def build_thumbnails(index_dir: Path, paths, widths, fmt=DEFAULT_FORMAT, workers=4, prune=False):
+    """Pre-generate <index_dir>/thumbnails/ for every image path at each width.
+
+    Images are decoded once for all widths, in parallel; derivatives that
+    already exist are left alone. With prune, derivatives of images that are
+    no longer indexed are deleted.
+    """
+    out = index_dir / THUMBNAIL_DIR
+
+    def make(p):
+        st = os.stat(p)
+        rels = [thumbnail_relpath(p, st, w, fmt) for w in widths]
+        todo = [(w, out / rel) for w, rel in zip(widths, rels) if not (out / rel).exists()]
+        return rels, make_thumbnails(p, todo, fmt) if todo else 0, len(todo)
+
+    keep, written, made, failed = set(), 0, 0, 0
+    with tqdm(total=len(paths), desc="Thumbnails", mininterval=0.5, leave=True) as bar:
+        for p, result, err in prefetch(make, paths, workers=workers, depth=4 * workers):
+            bar.update(1)
+            if err is not None:
+                failed += 1
+                logging.warning(f"[skip thumbnail] {p}: {err}")
+                continue
+            keep.update(result[0])
+            written += result[1]
+            made += result[2]
+    removed = prune_thumbnails(out, keep) if prune and out.exists() else 0
+    logging.info(f"[OK] thumbnails {list(widths)} ({fmt}): {made} written ({written / 1e6:.1f} MB), "
+                 f"{failed} failed, {removed} stale removed, in {out}")
+
+
+def file_key(p):
+    """(mtime_ns, size) of an image file, or None if it cannot be stat'ed."""
+    try:
+        st = os.stat(p)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class EmbeddingStore:
+    """Checkpointed embeddings: shards/shard_NNNNN.npy plus an append-only shards/manifest.jsonl.
+
+    Every manifest line describes one completed shard: for each vector the
+    image path, its (mtime_ns, size) key, sha256 and CSV metadata. A shard file
+    is written before the manifest line that references it, so a crash loses at
+    most the unfinished shard and re-running resumes after the last good one.
+    Locations are (shard, offset) pairs.
+    """
+    def __init__(self, index_dir: Path, model_name: str, dim: int, shard_size=1024):
+        self.dir = index_dir / "shards"
+        self.manifest_path = self.dir / "manifest.jsonl"
+        self.model_name = model_name
+        self.dim = dim
+        self.shard_size = shard_size
+        self.shards = []     # per shard: list of entry dicts
+        self.latest = {}     # image_path -> location of its newest vector
+        self._buf_vecs, self._buf_entries = [], []
+        self._mmaps = {}
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if self.manifest_path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        for n, line in enumerate(lines):
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # only the last line can be torn by a crash mid-write
+                logging.warning(f"Ignoring unreadable manifest line {n+1} in {self.manifest_path}")
+                continue
+            if self.model_name is None:
+                self.model_name = rec["model_name"]
+            if rec["model_name"] != self.model_name or rec["dim"] != self.dim:
+                raise RuntimeError(
+                    f"{self.dir} holds embeddings from {rec['model_name']} (dim {rec['dim']}); "
+                    f"use a new --index_dir or delete it to re-embed with {self.model_name}")
+            if rec["shard"] != len(self.shards) or not (self.dir / rec["file"]).exists():
+                logging.warning(f"Manifest line {n+1} does not match shard files; ignoring the rest")
+                break
+            for off, e in enumerate(rec["entries"]):
+                self.latest[e["image_path"]] = (rec["shard"], off)
+            self.shards.append(rec["entries"])
+        logging.info(f"Resuming from {len(self.shards)} checkpointed shards ({len(self.latest)} images)")
+
+    def entry(self, loc):
+        return self.shards[loc[0]][loc[1]]
+
+    def current(self, image_path, key):
+        """Location of the stored vector for image_path if it still matches the file on disk."""
+        loc = self.latest.get(image_path)
+        if loc is None or key is None:
+            return None
+        e = self.entry(loc)
+        return tuple(loc) if [e["mtime_ns"], e["size"]] == key else None
+
+    def add(self, row, digest, key, vec):
+        self._buf_entries.append({
+            "image_path": row["image_path"],
+            "mtime_ns": key[0] if key else None,
+            "size": key[1] if key else None,
+            "sha256": digest,
+            "title": row["title"],
+            "artist": row["artist"],
+            "genre": row["genre"],
+        })
+        self._buf_vecs.append(vec)
+        if len(self._buf_vecs) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buf_vecs:
+            return
+        shard = len(self.shards)
+        name = f"shard_{shard:05d}.npy"
+        tmp = self.dir / (name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.stack(self._buf_vecs).astype("float32"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.dir / name)
+        rec = {"shard": shard, "file": name, "model_name": self.model_name, "dim": self.dim,
+               "entries": self._buf_entries}
+        with open(self.manifest_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for off, e in enumerate(self._buf_entries):
+            self.latest[e["image_path"]] = (shard, off)
+        self.shards.append(self._buf_entries)
+        self._buf_vecs, self._buf_entries = [], []
+
+    def vectors(self, locs):
+        """Gather vectors for a list of locations from the memory-mapped shards."""
+        out = np.empty((len(locs), self.dim), dtype="float32")
+        for i, (s, o) in enumerate(locs):
+            if s not in self._mmaps:
+                self._mmaps[s] = np.load(self.dir / f"shard_{s:05d}.npy", mmap_mode="r")
+            out[i] = self._mmaps[s][o]
+        return out
+
+
+def meta_entry(e):
+    """The meta.json view of a store entry."""
+    return {"title": e["title"], "artist": e["artist"], "genre": e["genre"], "image_path": e["image_path"]}
+
+
+def _replace_json(path: Path, obj, **kw):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, **kw)
+    os.replace(tmp, path)
+
+
+def load_index_files(index_dir: Path):
+    """index, spec and per-id store locations of an index written by this script.
+
+    For a sharded index, `index` is the trained but empty index the shards were cloned from.
+    """
+    loc_path = index_dir / "id_locations.json"
+    if not loc_path.exists():
+        raise RuntimeError(f"{index_dir} was built without embedding checkpoints; rebuild it once before using --append/--remove")
+    with open(index_dir / "index_config.json", "r", encoding="utf-8") as f:
+        spec = IndexSpec.from_config(json.load(f))
+    with open(loc_path, "r", encoding="utf-8") as f:
+        locations = [tuple(l) if l else None for l in json.load(f)]
+    if spec.shards:
+        index = faiss.read_index(str(index_dir / INDEX_SHARDS_DIR / SHARD_TEMPLATE))
+    else:
+        index = faiss.read_index(str(index_dir / "index.faiss"))
+    return index, spec, locations
+
+
+def _id_order_vectors(store: EmbeddingStore, locations, d, chunk=4096):
+    """(first id, vectors) chunks in id order; removed ids get zero rows."""
+    for start in range(0, len(locations), chunk):
+        part = locations[start:start + chunk]
+        z = np.zeros((len(part), d), dtype="float32")
+        have = [j for j, l in enumerate(part) if l]
+        if have:
+            z[have] = store.vectors([part[j] for j in have])
+        yield start, z
+
+
+def shard_assignment(spec: IndexSpec, entries):
+    """Ids per shard: equal-sized contiguous id ranges, or whole genres packed largest-first into the smallest shard."""
+    live = [i for i, e in enumerate(entries) if e is not None]
+    n = min(spec.shards, len(live))
+    if spec.shard_by == "range":
+        return [ids.tolist() for ids in np.array_split(np.array(live, dtype="int64"), n)]
+    genres = {}
+    for i in live:
+        genres.setdefault(str(entries[i]["genre"]), []).append(i)
+    shards = [[] for _ in range(n)]
+    for ids in sorted(genres.values(), key=len, reverse=True):
+        min(shards, key=len).extend(ids)
+    empty = sum(1 for ids in shards if not ids)
+    if empty:
+        logging.warning(f"Only {len(genres)} distinct genres; writing {n - empty} shards instead of {spec.shards}")
+    return [sorted(ids) for ids in shards if ids]
+
+
+def write_index_shards(index_dir: Path, template, spec: IndexSpec, store: EmbeddingStore, locations, chunk=4096):
+    """Write index_shards/: one index per shard cloned from the trained `template`, holding global ids,
+    plus its id list and a manifest. The directory is swapped in by rename like meta_columns/."""
+    entries = [store.entry(l) if l else None for l in locations]
+    target = index_dir / INDEX_SHARDS_DIR
+    tmp = index_dir / f"{INDEX_SHARDS_DIR}.tmp"
+    old = index_dir / f"{INDEX_SHARDS_DIR}.old"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    faiss.write_index(template, str(tmp / SHARD_TEMPLATE))
+
+    shards = []
+    for k, ids in enumerate(shard_assignment(spec, entries)):
+        index = faiss.clone_index(template)
+        for s in range(0, len(ids), chunk):
+            part = ids[s:s + chunk]
+            index.add_with_ids(store.vectors([locations[i] for i in part]), np.array(part, dtype="int64"))
+        finalize_index(index, spec)
+        name = f"shard_{k:03d}"
+        faiss.write_index(index, str(tmp / f"{name}.faiss"))
+        np.save(tmp / f"{name}.ids.npy", np.array(ids, dtype="int64"))
+        shards.append({
+            "name": name,
+            "file": f"{name}.faiss",
+            "ids_file": f"{name}.ids.npy",
+            "ntotal": int(index.ntotal),
+            "id_min": int(ids[0]),
+            "id_max": int(ids[-1]),
+            "genres": sorted({str(entries[i]["genre"]) for i in ids}) if spec.shard_by == "genre" else None,
+        })
+        logging.info(f"Index shard {name}: {index.ntotal} vectors, ids {ids[0]}..{ids[-1]}")
+    manifest = {
+        "format": SHARDS_FORMAT,
+        "shard_by": spec.shard_by,
+        "index_type": spec.index_type,
+        "dim": int(template.d),
+        "total_ids": len(locations),
+        "ntotal": sum(sh["ntotal"] for sh in shards),
+        "template": SHARD_TEMPLATE,
+        "shards": shards,
+    }
+    _replace_json(tmp / SHARDS_MANIFEST, manifest, indent=2)
+
+    if target.exists():
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+    return manifest["ntotal"]
+
+
+def save_index_files(index_dir: Path, index, spec: IndexSpec, store: EmbeddingStore, locations):
+    """Atomically replace index.faiss, meta.json, id_locations.json, hashes.json, index_config.json
+    and (with spec.rerank) rerank_vectors.npy, then rewrite the memory-mappable meta_columns/
+    derived from meta.json and hashes.json.
+
+    locations[i] is the store location of id i, or None once it was removed;
+    meta.json keeps a null at that position so ids stay stable. With spec.shards,
+    `index` is the trained empty index and index_shards/ is written from the store instead.
+    """
+    entries = [store.entry(l) if l else None for l in locations]
+    if spec.shards:
+        ntotal = write_index_shards(index_dir, index, spec, store, locations)
+        if (index_dir / "index.faiss").exists():
+            (index_dir / "index.faiss").unlink()
+    else:
+        tmp = index_dir / "index.faiss.tmp"
+        faiss.write_index(index, str(tmp))
+        os.replace(tmp, index_dir / "index.faiss")
+        ntotal = index.ntotal
+        shutil.rmtree(index_dir / INDEX_SHARDS_DIR, ignore_errors=True)
+    _replace_json(index_dir / "meta.json", [e and meta_entry(e) for e in entries], ensure_ascii=False, indent=2)
+    _replace_json(index_dir / "id_locations.json", [list(l) if l else None for l in locations])
+    _replace_json(index_dir / "index_config.json", spec.to_config(index.d, ntotal), indent=2)
+    rerank_path = index_dir / RERANK_FILE
+    if spec.rerank:
+        write_rerank_store(rerank_path, len(locations), index.d, spec.rerank, _id_order_vectors(store, locations, index.d))
+    elif rerank_path.exists():
+        rerank_path.unlink()
+    hashes = {}
+    for i, e in enumerate(entries):
+        if e is not None:
+            # duplicates keep the first id, matching what a search would return first
+            hashes.setdefault(e["sha256"], i)
+    save_content_hashes(hashes, index_dir)
+    write_metadata_columns(index_dir)
+    layout = f"{spec.shards} {spec.shard_by} shards" if spec.shards else "index.faiss"
+    logging.info(f"[OK] saved index ({ntotal} vectors, {layout}) and metadata to {index_dir}")
+
+
+def read_path_list(p: Path):
+    """Image paths to remove: a CSV with an image_path column, or one path per line."""
+    if p.suffix.lower() == ".csv":
+        return set(pd.read_csv(p)["image_path"])
+    with open(p, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def remove_ids(index, spec: IndexSpec, ids):
+    try:
+        index.remove_ids(np.array(ids, dtype="int64"))
+    except RuntimeError as e:
+        raise RuntimeError(f"{spec.index_type} index does not support removal; rebuild without those rows ({e})")
+
+
+def remove_from_index(index_dir: Path, paths):
+    """Drop images from an existing index in place, without loading the model."""
+    index, spec, locations = load_index_files(index_dir)
+    store = EmbeddingStore(index_dir, model_name=None, dim=index.d)
+    ids = [i for i, l in enumerate(locations) if l and store.entry(l)["image_path"] in paths]
+    logging.info(f"Removing {len(ids)} of {len(paths)} requested paths from {index_dir}")
+    if not ids:
+        return
+    if not spec.shards:
+        # shards are rebuilt from the remaining checkpointed embeddings by save_index_files
+        remove_ids(index, spec, ids)
+    for i in ids:
+        locations[i] = None
+    save_index_files(index_dir, index, spec, store, locations)
+
+
 class CLIPIndexer:
-    def __init__(self, model_name="openai/clip-vit-base-patch32", device=None, local_only=False):
+    def __init__(self, model_name="openai/clip-vit-base-patch32", device=None, local_only=False,
+                 backend="eager", backend_tolerance=0.01, vision_only=False):
         self.device = pick_device(device)
         self.local_only = local_only
 
@@ -75,17 +765,36 @@ class CLIPIndexer:
         logging.info(f"Loading model {model_name} (local_only={self.local_only}) ...")
         t0 = time.time()
         try:
-            self.model = CLIPModel.from_pretrained(model_name, local_files_only=self.local_only).to(self.device).eval()
-            self.proc  = CLIPProcessor.from_pretrained(model_name, local_files_only=self.local_only)
+            if vision_only:
+                # 只加载视觉塔 + 投影层（也可以是 --export_vision 导出的本地目录）
+                self.model, self.proc = load_vision_model(model_name, self.device, local_only=self.local_only)
+            else:
+                from transformers import CLIPProcessor, CLIPModel
+                self.model = CLIPModel.from_pretrained(model_name, local_files_only=self.local_only).to(self.device).eval()
+                self.proc  = CLIPProcessor.from_pretrained(model_name, local_files_only=self.local_only)
         except Exception as e:
             logging.error("Failed to load model. If this is stuck on downloading, try setting --local_only or pre-download the model with `huggingface-cli download`.")
             raise
         logging.info(f"Model loaded in {time.time()-t0:.1f}s")
 
-        self.index = None
-        self.meta = None
+        self.model_name = model_name
+        self.dim = self.model.config.projection_dim
+        self.encoder = ImageEncoder(self.model, self.proc, backend=backend, device=self.device,
+                                    tolerance=backend_tolerance, model_name=model_name)
+        self.preprocess = ClipPreprocess(self.proc)
+
+    def embed_batch(self, imgs):
+        inp = self.proc(images=imgs, return_tensors="pt")
+        return self.embed_pixels(inp["pixel_values"])
 
     @torch.no_grad()
+    def embed_pixels(self, pixel_values):
+        if isinstance(pixel_values, np.ndarray):
+            pixel_values = torch.from_numpy(pixel_values)
+        z = self.encoder(pixel_values.to(self.device))
+        z = torch.nn.functional.normalize(z, p=2, dim=1)
+        return z.cpu().numpy().astype("float32")
+
     def embed_pil(self, imgs, batch=16):
         zs=[]
         total_batches = (len(imgs) + batch - 1) // batch
@@ -93,84 +802,296 @@ class CLIPIndexer:
             s = bi*batch
             e = min((bi+1)*batch, len(imgs))
             logging.info(f"Embedding batch {bi+1}/{total_batches} (images {s}-{e-1})")
-            inp = self.proc(images=imgs[s:e], return_tensors="pt").to(self.device)
-            z = self.model.get_image_features(**inp)
-            z = torch.nn.functional.normalize(z, p=2, dim=1)
-            zs.append(z.cpu().numpy().astype("float32"))
+            zs.append(self.embed_batch(imgs[s:e]))
         return np.concatenate(zs, 0)
 
-    def build_and_save(self, meta_csv: Path, index_dir: Path, batch=16):
+    def iter_embedded(self, rows, row_ids, batch=16, workers=4, processes=0):
+        """Stream (entries, vectors) batches for rows[row_ids].
+
+        Images are decoded by `workers` threads running at most a few batches
+        ahead, so decoding overlaps the forward pass and only O(batch) images
+        are alive at once. With `processes` > 0, a pool of that many processes
+        also EXIF-transposes and CLIP-preprocesses them, handing ready pixel
+        arrays to the forward pass. entries are (row_id, digest, file_key);
+        unreadable images are skipped, but an LFS pointer stub stops the build.
+        """
+        def load(i):
+            p = Path(rows[i]["image_path"])
+            key = file_key(p)
+            img, digest = read_image(p)
+            return img, digest, key
+
+        def flush(pending):
+            if processes:
+                z = self.embed_pixels(np.stack([px for _, (px, _, _) in pending]))
+            else:
+                z = self.embed_batch([img for _, (img, _, _) in pending])
+            return [(i, digest, key) for i, (_, digest, key) in pending], z
+
+        pending = []
+        if processes:
+            fn, items = partial(load_preprocessed, preprocess=self.preprocess), ((i, rows[i]["image_path"]) for i in row_ids)
+        else:
+            fn, items = load, row_ids
+        n = processes or workers
+        depth = max(2 * batch, 2 * n)
+        for item, result, err in prefetch(fn, items, workers=n, depth=depth, processes=bool(processes)):
+            i = item[0] if processes else item
+            if isinstance(err, LFSPointerError):
+                raise err
+            if err is not None:
+                self.skipped += 1
+                logging.warning(f"[skip] {rows[i]['image_path']}: {err}")
+                continue
+            pending.append((i, result))
+            if len(pending) == batch:
+                yield flush(pending)
+                pending = []
+        if pending:
+            yield flush(pending)
+
+    def read_rows(self, meta_csv: Path):
         logging.info(f"Reading metadata CSV: {meta_csv}")
         df = pd.read_csv(meta_csv)
         assert {"image_path","artist","genre","title"}.issubset(df.columns), "CSV must contain columns: image_path, artist, genre, title"
         rows = df.to_dict("records")
         logging.info(f"Total rows in CSV: {len(rows)}")
+        return rows
+
+    def embed_missing(self, rows, store: EmbeddingStore, batch=16, workers=4, processes=0):
+        """Embed every CSV row without an up-to-date checkpoint; returns the store location per row (None if unreadable)."""
+        self.skipped = 0
+        keys = [file_key(r["image_path"]) for r in rows]
+        locs = [store.current(r["image_path"], k) for r, k in zip(rows, keys)]
+        todo = [i for i, l in enumerate(locs) if l is None]
+        logging.info(f"{len(rows) - len(todo)} rows already embedded, {len(todo)} to embed")
+
+        with tqdm(total=len(todo), desc="Embedding images", mininterval=0.5, leave=True) as bar:
+            for entries, z in self.iter_embedded(rows, todo, batch=batch, workers=workers, processes=processes):
+                for (i, digest, key), v in zip(entries, z):
+                    store.add(rows[i], digest, key, v)
+                bar.update(len(entries))
+                bar.set_postfix(skipped=self.skipped)
+        store.flush()
+        logging.info(f"Embedded {len(todo) - self.skipped} images, skipped {self.skipped}")
+
+        # after the flush every successfully embedded row has a checkpoint matching its key
+        return [l or store.current(r["image_path"], k) for r, k, l in zip(rows, keys, locs)]
+
+    def build_and_save(self, meta_csv: Path, index_dir: Path, batch=16, spec: IndexSpec = None,
+                       eval_recall=False, workers=4, shard_size=1024, thumbnail_widths=None,
+                       thumbnail_format=DEFAULT_FORMAT, processes=0):
+        """Full build. Embeddings are checkpointed per shard, so an interrupted build resumes where it stopped."""
+        spec = spec or IndexSpec()
+        rows = self.read_rows(meta_csv)
 
         # 心跳开始（最容易卡的是这里的模型加载与图片 IO/解码）
         hb = Heartbeat(interval=20)
         hb.start()
+        try:
+            index_dir.mkdir(parents=True, exist_ok=True)
+            store = EmbeddingStore(index_dir, self.model_name, self.dim, shard_size=shard_size)
+            row_locs = self.embed_missing(rows, store, batch=batch, workers=workers, processes=processes)
 
-        imgs, meta = [], []
-        skipped = 0
-        for r in tqdm(rows, desc="Loading images", mininterval=0.5, leave=True):
-            p = Path(r["image_path"])
-            try:
-                imgs.append(exif_open(p))
-                meta.append({
-                    "title": r["title"],
-                    "artist": r["artist"],
-                    "genre": r["genre"],
-                    "image_path": r["image_path"]
-                })
-            except Exception as e:
-                skipped += 1
-                logging.warning(f"[skip] {p}: {e}")
+            # one id per distinct image path, in CSV order
+            live, seen = [], set()
+            for r, l in zip(rows, row_locs):
+                if l is not None and r["image_path"] not in seen:
+                    seen.add(r["image_path"])
+                    live.append(l)
+            if not live:
+                raise RuntimeError("No images loaded. Please check your image_path in CSV.")
 
-        logging.info(f"Loaded {len(imgs)} images, skipped {skipped}")
+            index = spec.wrap_ids(spec.build(self.dim, len(live)))
+            if not index.is_trained:
+                sample = spec.training_rows(len(live))
+                t0 = time.time()
+                index.train(store.vectors([live[i] for i in sample]))
+                logging.info(f"Trained {spec.index_type} index on {len(sample)} vectors (nlist={spec.nlist}) in {time.time()-t0:.1f}s")
 
-        if len(imgs) == 0:
+            if spec.shards and eval_recall:
+                logging.warning("--eval_recall is not supported with --index_shards; skipping it")
+                eval_recall = False
+            exact = faiss.IndexFlatIP(self.dim) if eval_recall else None
+            if not spec.shards:
+                chunk = max(batch, shard_size)
+                for s in tqdm(range(0, len(live), chunk), desc="Indexing", mininterval=0.5, leave=True):
+                    z = store.vectors(live[s:s + chunk])
+                    index.add_with_ids(z, np.arange(s, s + len(z), dtype="int64"))
+                    if exact is not None:
+                        exact.add(z)
+                finalize_index(index, spec)
+            # a sharded build saves the trained empty index; the shards are filled from the store
+            save_index_files(index_dir, index, spec, store, live)
+            if thumbnail_widths:
+                build_thumbnails(index_dir, [store.entry(l)["image_path"] for l in live], thumbnail_widths,
+                                 thumbnail_format, workers=workers, prune=True)
+
+            if eval_recall:
+                logging.info("Evaluating recall against exact search ...")
+                rng = np.random.default_rng(spec.seed)
+                q = sorted(rng.choice(len(live), size=min(200, len(live)), replace=False).tolist())
+                report = evaluate_recall(index, exact, store.vectors([live[i] for i in q]), spec)
+                _replace_json(index_dir / "recall_report.json", report, indent=2)
+                logging.info(f"[OK] saved recall report to {index_dir / 'recall_report.json'}")
+        finally:
             hb.stop()
-            raise RuntimeError("No images loaded. Please check your image_path in CSV.")
 
-        feats = self.embed_pil(imgs, batch=batch)
-        logging.info(f"Embedding done. Features shape = {feats.shape}")
+    def append(self, meta_csv: Path, index_dir: Path, batch=16, workers=4, shard_size=1024,
+               thumbnail_widths=None, thumbnail_format=DEFAULT_FORMAT, processes=0):
+        """Add new (or changed) CSV rows to an existing index in place, without a rebuild.
 
-        index = faiss.IndexFlatIP(feats.shape[1])
-        index.add(feats)
+        Rows whose file is unchanged are left alone; a changed file replaces its old id.
+        """
+        index, spec, locations = load_index_files(index_dir)
+        rows = self.read_rows(meta_csv)
+        hb = Heartbeat(interval=20)
+        hb.start()
+        try:
+            store = EmbeddingStore(index_dir, self.model_name, self.dim, shard_size=shard_size)
+            row_locs = self.embed_missing(rows, store, batch=batch, workers=workers, processes=processes)
 
-        index_dir.mkdir(parents=True, exist_ok=True)
-        faiss.write_index(index, str(index_dir / "index.faiss"))
-        with open(index_dir / "meta.json", "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False, indent=2)
-        logging.info(f"[OK] saved index and metadata to {index_dir}")
+            path_to_id = {store.entry(l)["image_path"]: i for i, l in enumerate(locations) if l}
+            stale, new, seen = [], [], set()
+            for r, l in zip(rows, row_locs):
+                p = r["image_path"]
+                if l is None or p in seen:
+                    continue
+                seen.add(p)
+                old = path_to_id.get(p)
+                if old is not None:
+                    if locations[old] == l:
+                        continue
+                    stale.append(old)
+                new.append(l)
+            logging.info(f"Appending {len(new)} images ({len(stale)} of them replace changed files)")
+            if not new:
+                return
 
-        hb.stop()
+            if stale and not spec.shards:
+                # a changed file replaces its old id, which needs removal support
+                remove_ids(index, spec, stale)
+            for i in stale:
+                locations[i] = None
+            start = len(locations)
+            if not spec.shards:
+                index.add_with_ids(store.vectors(new), np.arange(start, start + len(new), dtype="int64"))
+                finalize_index(index, spec)
+            locations.extend(new)
+            # a sharded index is re-split and rebuilt from the checkpointed embeddings
+            save_index_files(index_dir, index, spec, store, locations)
+            if thumbnail_widths:
+                build_thumbnails(index_dir, [store.entry(l)["image_path"] for l in new], thumbnail_widths,
+                                 thumbnail_format, workers=workers)
+        finally:
+            hb.stop()
 
 
 if __name__ == "__main__":
     import argparse
     ap = argparse.ArgumentParser()
-    ap.add_argument("--meta_csv", required=True, help="subset_metadata.csv")
-    ap.add_argument("--index_dir", required=True, help="output dir for index.faiss + meta.json")
+    ap.add_argument("--meta_csv", help="subset_metadata.csv")
+    ap.add_argument("--index_dir", help="output dir for index.faiss + meta.json")
     ap.add_argument("--model_name", default="openai/clip-vit-base-patch32")
     ap.add_argument("--batch", type=int, default=16)
+    ap.add_argument("--decode_workers", type=int, default=4, help="threads decoding images ahead of the embedding loop")
+    ap.add_argument("--workers", type=int, default=0, help="processes decoding + CLIP-preprocessing images (0 = use --decode_workers threads)")
     ap.add_argument("--device", default=None, help="force device: cuda | mps | cpu")
     ap.add_argument("--log_file", default="logs/run.log", help="Path to save log file")
     ap.add_argument("--quiet", action="store_true", help="less console logs")
+    ap.add_argument("--backend", default="eager", choices=BACKENDS, help="image encoder backend (checked against fp32 before use)")
+    ap.add_argument("--backend_tolerance", type=float, default=0.01, help="max cosine distance from fp32 embeddings for --backend")
+    ap.add_argument("--vision_only", action="store_true", help="load only the vision tower + projection (no text encoder)")
+    ap.add_argument("--export_vision", default=None, help="write the vision tower of --model_name to this dir (safetensors) and exit")
     ap.add_argument("--local_only", action="store_true", help="do not attempt to download weights; use local cache only")
+    ap.add_argument("--index_type", default="flat", choices=INDEX_TYPES)
+    ap.add_argument("--nlist", type=int, default=None, help="IVF: number of inverted lists (default ~4*sqrt(N))")
+    ap.add_argument("--nprobe", type=int, default=16, help="IVF: lists probed per query at serving time")
+    ap.add_argument("--pq_m", type=int, default=64, help="PQ / IVF-PQ: sub-quantizers (must divide the embedding dim)")
+    ap.add_argument("--pq_nbits", type=int, default=8, help="PQ / IVF-PQ: bits per sub-quantizer code")
+    ap.add_argument("--hnsw_m", type=int, default=32, help="HNSW: graph neighbours per node")
+    ap.add_argument("--ef_construction", type=int, default=200, help="HNSW: build-time search depth")
+    ap.add_argument("--ef_search", type=int, default=64, help="HNSW: query-time search depth")
+    ap.add_argument("--rerank", default=None, choices=tuple(RERANK_DTYPES), help="also store fp16/fp32 vectors to rerank coarse candidates exactly")
+    ap.add_argument("--rerank_factor", type=int, default=4, help="coarse candidates per requested result when reranking")
+    ap.add_argument("--index_shards", type=int, default=0, help="split the index into N shards under index_shards/ (0 = one index.faiss)")
+    ap.add_argument("--shard_by", default="range", choices=SHARD_BY, help="assign vectors to index shards by id range or by genre")
+    ap.add_argument("--train_size", type=int, default=None, help="vectors sampled for IVF/PQ training")
+    ap.add_argument("--eval_recall", action="store_true", help="write recall_report.json (recall@k vs latency against flat search)")
+    ap.add_argument("--shard_size", type=int, default=1024, help="vectors per embedding checkpoint shard")
+    ap.add_argument("--thumbnails", action="store_true", help="also pre-generate resized copies of every image for /image?size=")
+    ap.add_argument("--thumbnail_widths", default=",".join(map(str, DEFAULT_WIDTHS)), help="comma-separated thumbnail widths in pixels")
+    ap.add_argument("--thumbnail_format", default=DEFAULT_FORMAT, choices=tuple(FORMATS))
+    ap.add_argument("--append", action="store_true", help="add new/changed rows of --meta_csv to the existing index in place")
+    ap.add_argument("--remove", default=None, help="CSV (image_path column) or text file of image paths to drop from the existing index")
+    ap.add_argument("--hashes_only", action="store_true", help="only (re)write hashes.json for the existing index in --index_dir")
+    ap.add_argument("--path_map", default=None, help="OLD=NEW prefix rewrite for image_path entries (with --hashes_only)")
     args = ap.parse_args()
 
     setup_logger(Path(args.log_file), verbose=not args.quiet)
 
+    if args.export_vision:
+        export_vision_model(args.model_name, Path(args.export_vision), local_only=args.local_only)
+        sys.exit(0)
+    if not args.index_dir:
+        ap.error("--index_dir is required unless --export_vision is given")
+    if args.hashes_only:
+        path_map = tuple(args.path_map.split("=", 1)) if args.path_map else None
+        backfill_content_hashes(Path(args.index_dir), path_map=path_map)
+        sys.exit(0)
+    if args.remove:
+        remove_from_index(Path(args.index_dir), read_path_list(Path(args.remove)))
+        sys.exit(0)
+    if not args.meta_csv:
+        ap.error("--meta_csv is required unless --hashes_only or --remove is given")
+
     # 可选：加速 huggingface 下载（如有网络）
     os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
 
-    CLIPIndexer(
+    thumbnail_widths = parse_widths(args.thumbnail_widths) if args.thumbnails else None
+    indexer = CLIPIndexer(
         model_name=args.model_name,
         device=args.device,
-        local_only=args.local_only
-    ).build_and_save(
+        local_only=args.local_only,
+        backend=args.backend,
+        backend_tolerance=args.backend_tolerance,
+        vision_only=args.vision_only
+    )
+    if args.append:
+        indexer.append(
+            meta_csv=Path(args.meta_csv),
+            index_dir=Path(args.index_dir),
+            batch=args.batch,
+            workers=args.decode_workers,
+            shard_size=args.shard_size,
+            thumbnail_widths=thumbnail_widths,
+            thumbnail_format=args.thumbnail_format,
+            processes=args.workers
+        )
+        sys.exit(0)
+    indexer.build_and_save(
         meta_csv=Path(args.meta_csv),
         index_dir=Path(args.index_dir),
-        batch=args.batch
+        batch=args.batch,
+        spec=IndexSpec(
+            index_type=args.index_type,
+            nlist=args.nlist,
+            nprobe=args.nprobe,
+            pq_m=args.pq_m,
+            pq_nbits=args.pq_nbits,
+            hnsw_m=args.hnsw_m,
+            ef_construction=args.ef_construction,
+            ef_search=args.ef_search,
+            train_size=args.train_size,
+            rerank=args.rerank,
+            rerank_factor=args.rerank_factor,
+            shards=args.index_shards,
+            shard_by=args.shard_by,
+        ),
+        eval_recall=args.eval_recall,
+        workers=args.decode_workers,
+        shard_size=args.shard_size,
+        thumbnail_widths=thumbnail_widths,
+        thumbnail_format=args.thumbnail_format,
+        processes=args.workers
     )
@@ -0,0 +1,214 @@
+"""
+Optional accelerated backends for the CLIP image encoder.
+
+Both the API and build_index.py embed images through `ImageEncoder`, which
+runs the fp32 model eagerly by default or one of the CPU-oriented variants in
+`BACKENDS`. A variant is only used if its embeddings stay within a cosine
+tolerance of the fp32 ones on a calibration batch; otherwise the encoder falls
+back to eager, so vectors already stored in an index stay comparable.
+
+It also loads just the vision tower + projection for image-only use, either
+from the hub or from a local safetensors artifact written by
+`export_vision_model`; transformers is only imported when a model is loaded.
+"""
+import logging
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "int8", "bf16", "compile", "torchscript", "onnx")
+CPU_ONLY_BACKENDS = ("int8", "onnx")
+
+class ImageTower(torch.nn.Module):
+    """pixel_values -> projected (unnormalized) features, same as CLIPModel.get_image_features"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pooled = self.vision_model(pixel_values=pixel_values, return_dict=False)[1]
+        return self.visual_projection(pooled)
+
+def load_vision_model(source: str, device: str = "cpu", local_only: bool = False):
+    """
+    (CLIPVisionModelWithProjection, CLIPImageProcessor) from a hub model name or
+    a directory written by `export_vision_model`. The text tower and tokenizer
+    are never loaded; safetensors weights are memory-mapped while loading.
+    """
+    from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
+
+    model = CLIPVisionModelWithProjection.from_pretrained(
+        source, local_files_only=local_only, low_cpu_mem_usage=True)
+    processor = CLIPImageProcessor.from_pretrained(source, local_files_only=local_only)
+    return model.to(device).eval(), processor
+
+def export_vision_model(model_name: str, out_dir: Path, local_only: bool = False):
+    """Save the vision tower + projection and image processor of `model_name` as a local safetensors artifact"""
+    model, processor = load_vision_model(model_name, "cpu", local_only)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(out_dir, safe_serialization=True)
+    processor.save_pretrained(out_dir)
+    logger.info(f"Exported vision model of {model_name} to {out_dir}")
+
+def calibration_pixels(processor, n: int = 8, size: int = 224, seed: int = 0) -> torch.Tensor:
+    """Deterministic calibration batch (smooth gradients plus noise) in CLIP's input format"""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    images = []
+    for _ in range(n):
+        base = rng.uniform(0.2, 1.0, 3) * (ramp[None, :, None] + ramp[:, None, None]) / 2
+        noise = rng.normal(0, rng.uniform(5, 60), (size, size, 3))
+        images.append(Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8)))
+    return processor(images=images, return_tensors="pt")["pixel_values"]
+
+def build_int8(tower: ImageTower, example: torch.Tensor, device: str, export_dir: Path) -> Callable:
+    # Dynamic quantization of the Linear layers (the bulk of a ViT); weights are
+    # converted once, activations are quantized on the fly
+    return torch.ao.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+
+def build_bf16(tower: ImageTower, example: torch.Tensor, device: str, export_dir: Path) -> Callable:
+    device_type = torch.device(device).type
+
+    def run(pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            return tower(pixel_values)
+    return run
+
+def build_compile(tower: ImageTower, example: torch.Tensor, device: str, export_dir: Path) -> Callable:
+    # Batch sizes vary with load, so compile for a dynamic batch dimension
+    return torch.compile(tower, dynamic=True)
+
+def build_torchscript(tower: ImageTower, example: torch.Tensor, device: str, export_dir: Path) -> Callable:
+    traced = torch.jit.trace(tower, example, check_trace=False)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+def build_onnx(tower: ImageTower, example: torch.Tensor, device: str, export_dir: Path) -> Callable:
+    import onnxruntime as ort  # optional dependency, only needed for this backend
+
+    export_dir.mkdir(parents=True, exist_ok=True)
+    path = export_dir / "clip-image-encoder.onnx"
+    # Exported under a unique name and renamed into place, so a shared
+    # `export_dir` never exposes a partially written model
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", dir=export_dir)
+    os.close(fd)
+    try:
+        torch.onnx.export(tower, (example,), tmp_name, input_names=["pixel_values"],
+                          output_names=["image_embeds"], opset_version=17,
+                          dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}})
+        os.replace(tmp_name, path)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    session = ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    logger.info(f"Exported image encoder to {path}")
+
+    def run(pixel_values: torch.Tensor) -> torch.Tensor:
+        outputs = session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+    return run
+
+BUILDERS = {
+    "int8": build_int8,
+    "bf16": build_bf16,
+    "compile": build_compile,
+    "torchscript": build_torchscript,
+    "onnx": build_onnx,
+}
+
+def _time_per_image(fn: Callable, pixel_values: torch.Tensor, repeats: int) -> float:
+    fn(pixel_values)  # warm-up (compilation, allocator, oneDNN primitive caches)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn(pixel_values)
+    return (time.perf_counter() - t0) / (repeats * len(pixel_values))
+
+@torch.no_grad()
+def compare_backends(reference: Callable, candidate: Callable, pixel_values: torch.Tensor,
+                     repeats: int = 3) -> Dict[str, float]:
+    """Cosine agreement and per-image latency of `candidate` against the fp32 `reference`"""
+    expected = torch.nn.functional.normalize(reference(pixel_values).float(), dim=1)
+    actual = torch.nn.functional.normalize(candidate(pixel_values).float().to(expected.device), dim=1)
+    cosine = (expected * actual).sum(dim=1)
+    reference_s = _time_per_image(reference, pixel_values, repeats)
+    candidate_s = _time_per_image(candidate, pixel_values, repeats)
+    return {
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "eager_ms_per_image": reference_s * 1000,
+        "backend_ms_per_image": candidate_s * 1000,
+        "speedup": reference_s / candidate_s if candidate_s > 0 else 0.0,
+    }
+
+def _export_dir(model_name: str) -> Path:
+    # Private to this process: uvicorn workers starting together must not
+    # export over (or load) each other's half-written files
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+    return Path(tempfile.mkdtemp(prefix=f"image_finder-{safe_name}-"))
+
+class ImageEncoder:
+    """
+    Callable mapping CLIP `pixel_values` to unnormalized image features.
+
+    `backend` selects how the vision tower runs (see `BACKENDS`). Anything but
+    "eager" is built at construction time and checked against the fp32 model
+    on a calibration batch; if building fails or the minimum cosine similarity
+    is below `1 - tolerance`, the encoder stays on eager.
+    """
+
+    def __init__(self, model, processor, backend: str = "eager", device: str = "cpu",
+                 tolerance: float = 0.01, model_name: str = "clip", export_dir: Optional[Path] = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {BACKENDS}")
+        self.requested = backend
+        self.backend = "eager"
+        self.device = device
+        self.tolerance = tolerance
+        self.report: Dict[str, Any] = {}
+        self._eager = ImageTower(model).eval()
+        self._run: Callable = self._eager
+        if backend == "eager":
+            return
+        if backend in CPU_ONLY_BACKENDS and torch.device(device).type != "cpu":
+            logger.warning(f"Encoder backend {backend!r} is CPU-only, using eager on {device}")
+            return
+
+        pixel_values = calibration_pixels(processor).to(device)
+        try:
+            with torch.no_grad():
+                # Built from a different batch size than the check uses, so traced
+                # graphs are also verified to generalize across batch sizes
+                run = BUILDERS[backend](self._eager, pixel_values[:2], device,
+                                        export_dir or _export_dir(model_name))
+            self.report = compare_backends(self._eager, run, pixel_values)
+        except Exception as e:
+            logger.error(f"Failed to build encoder backend {backend!r}, using eager: {e}")
+            self.report = {"error": str(e)}
+            return
+
+        if self.report["min_cosine"] < 1 - tolerance:
+            logger.error(f"Encoder backend {backend!r} deviates from fp32 (min cosine "
+                         f"{self.report['min_cosine']:.4f} < {1 - tolerance:.4f}), using eager")
+            return
+        self._run = run
+        self.backend = backend
+        logger.info(f"Encoder backend {backend!r}: min cosine {self.report['min_cosine']:.4f}, "
+                    f"{self.report['eager_ms_per_image']:.1f} -> {self.report['backend_ms_per_image']:.1f} "
+                    f"ms/image ({self.report['speedup']:.2f}x)")
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self._run(pixel_values).float().to(self.device)
+
+    def info(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "requested": self.requested,
+                "tolerance": self.tolerance, **self.report}
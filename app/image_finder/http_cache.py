@@ -0,0 +1,29 @@
+"""
+HTTP cache validators for `/image` responses.
+
+Artwork files and their derivatives only change when the file on disk does,
+so the ETag is derived from the file's size and mtime (plus the thumbnail
+width), and conditional requests are answered with 304 without opening it.
+"""
+import email.utils
+import os
+from typing import Optional
+
+def image_etag(stat_result: os.stat_result, width: Optional[int] = None) -> str:
+    suffix = f"-w{width}" if width else ""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}{suffix}"'
+
+def is_not_modified(etag: str, mtime: float, if_none_match: Optional[str],
+                    if_modified_since: Optional[str]) -> bool:
+    """RFC 9110 conditional GET: If-None-Match takes precedence over If-Modified-Since"""
+    if if_none_match is not None:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        # Weak comparison, as required for If-None-Match
+        return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since is not None and int(mtime) <= since.timestamp()
+    return False
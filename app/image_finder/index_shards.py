@@ -0,0 +1,337 @@
+"""
+FAISS index shards and scatter-gather search over them.
+
+build_index.py --index_shards N splits the index into N FAISS indexes under
+`<index_dir>/index_shards/`, by id range or by genre, described by
+`index_shards/manifest.json`. Every shard keeps the global ids, so merged
+results index straight into meta.json and the other global sidecar files;
+`shard_NNN.ids.npy` lists each shard's ids for routing reconstructions.
+
+`ShardedIndex` searches the shards in parallel on a thread pool (FAISS releases
+the GIL) and merges the per-shard top-k. It can serve a subset of the shards
+and load them lazily, and with `processes` > 0 it hosts the shards in local
+worker processes that stand in for separate nodes. The search-parameter
+helpers are shared with the single-index path in app.py.
+"""
+import json
+import logging
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_SHARDS_DIR = "index_shards"
+SHARDS_MANIFEST = "manifest.json"
+SHARDS_FORMAT = 1
+SHARD_BY = ("range", "genre")
+
+def unwrap_id_map(faiss_index):
+    """Indexes built with explicit ids wrap the searchable index in an IndexIDMap2"""
+    if isinstance(faiss_index, faiss.IndexIDMap):
+        return faiss.downcast_index(faiss_index.index)
+    return faiss_index
+
+def apply_search_params(faiss_index, search_params: Dict[str, Any], index_type: Optional[str]) -> Dict[str, Any]:
+    """Set nprobe / efSearch on `faiss_index` where they apply; returns the parameters actually set"""
+    search_params = dict(search_params)
+    ivf = faiss.try_extract_index_ivf(faiss_index)
+    if ivf is not None:
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # Needed for index.reconstruct (by-id search, indexed-upload short-circuit)
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        search_params.pop("nprobe", None)
+    if index_type != "hnsw":
+        search_params.pop("efSearch", None)
+
+    inner = unwrap_id_map(faiss_index)
+    parameter_space = faiss.ParameterSpace()
+    for name, value in search_params.items():
+        parameter_space.set_index_parameter(inner, name, value)
+    return search_params
+
+def selector_search_params(faiss_index, index_type: Optional[str], selector, exhaustive: bool = False):
+    """Search parameters restricted to `selector`, keeping the configured nprobe / efSearch"""
+    ivf = faiss.try_extract_index_ivf(faiss_index)
+    if ivf is not None:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = ivf.nlist if exhaustive else ivf.nprobe
+    elif index_type == "hnsw":
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = unwrap_id_map(faiss_index).hnsw.efSearch
+    else:
+        params = faiss.SearchParameters()
+    params.sel = selector
+    return params
+
+def read_index_file(path: Path, mmap: bool):
+    """
+    Read a FAISS index, memory-mapped read-only if `mmap`; returns (index, whether it is memory-mapped).
+
+    IO_FLAG_MMAP_IFC also maps flat codes but is rejected for IVF indexes,
+    whose inverted lists are mapped by IO_FLAG_MMAP alone, so that is tried
+    next before falling back to reading the file into memory. Without
+    IO_FLAG_MMAP_IFC, IO_FLAG_MMAP still loads flat / HNSW codes into RAM,
+    so only an IVF index read that way counts as memory-mapped.
+    """
+    if mmap:
+        base = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        for flags in ((base | ifc, base) if ifc else (base,)):
+            try:
+                index = faiss.read_index(str(path), flags)
+            except RuntimeError as e:
+                error = e
+                continue
+            if flags != base or faiss.try_extract_index_ivf(index) is not None:
+                return index, True
+            logger.warning(f"This faiss build cannot memory-map the codes of {path}, "
+                           f"they were read into memory")
+            return index, False
+        logger.warning(f"Cannot memory-map {path}, reading it into memory: {error}")
+    return faiss.read_index(str(path)), False
+
+def load_manifest(index_dir: Path) -> Optional[Dict[str, Any]]:
+    path = index_dir / INDEX_SHARDS_DIR / SHARDS_MANIFEST
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SHARDS_FORMAT:
+        raise ValueError(f"Unsupported index shard manifest format in {path}: {manifest.get('format')}")
+    return manifest
+
+def merge_results(results: Sequence[tuple], k: int):
+    """Global top-k (inner product, higher is better) of per-shard (scores, ids)"""
+    scores = np.concatenate([r[0] for r in results], axis=1)
+    ids = np.concatenate([r[1] for r in results], axis=1)
+    scores = np.where(ids >= 0, scores, -np.inf).astype(np.float32)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    scores = np.take_along_axis(scores, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    ids[~np.isfinite(scores)] = -1
+    return scores, ids
+
+class LocalShard:
+    """One shard file searched in this process, read on first use unless loaded up front"""
+
+    def __init__(self, entry: Dict[str, Any], path: Path, index_type: Optional[str],
+                 search_params: Dict[str, Any], mmap: bool):
+        self.name = entry["name"]
+        self.ntotal = entry["ntotal"]
+        self.path = path
+        self.index_type = index_type
+        self.search_params = search_params
+        self.mmap = mmap
+        self.mmapped = False
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._index is not None
+
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    index, self.mmapped = read_index_file(self.path, self.mmap)
+                    apply_search_params(index, self.search_params, self.index_type)
+                    self._index = index
+                    logger.info(f"Loaded index shard {self.name} ({index.ntotal} vectors)")
+        return self._index
+
+    def search(self, queries: np.ndarray, k: int, selector=None, selector_ids: Optional[np.ndarray] = None,
+               exhaustive: bool = False):
+        index = self.index()
+        if selector is None and selector_ids is None:
+            return index.search(queries, k)
+        if selector is None:
+            selector_ids = np.ascontiguousarray(selector_ids, dtype=np.int64)
+            selector = faiss.IDSelectorBatch(len(selector_ids), faiss.swig_ptr(selector_ids))
+        params = selector_search_params(index, self.index_type, selector, exhaustive)
+        return index.search(queries, k, params=params)
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        return self.index().reconstruct_batch(np.ascontiguousarray(ids, dtype=np.int64))
+
+def serve_shards(conn, shards: List[Dict[str, Any]], index_dir: str, index_type: Optional[str],
+                 search_params: Dict[str, Any], mmap: bool):
+    """Worker process main loop: answer search / reconstruct requests for `shards` over `conn`"""
+    local = {e["name"]: LocalShard(e, Path(index_dir) / INDEX_SHARDS_DIR / e["file"], index_type,
+                                   search_params, mmap) for e in shards}
+    for shard in local.values():
+        shard.index()
+    conn.send(("ready", {name: shard.mmapped for name, shard in local.items()}))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        op, name, args = request
+        if op == "stop":
+            return
+        try:
+            shard = local[name]
+            if op == "search":
+                result = shard.search(*args)
+            else:
+                result = shard.reconstruct_batch(*args)
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class RemoteShard:
+    """A shard hosted by a worker process; requests to one process are serialized, like calls to one node"""
+
+    def __init__(self, entry: Dict[str, Any], conn, lock: threading.Lock, mmapped: bool):
+        self.name = entry["name"]
+        self.ntotal = entry["ntotal"]
+        self.loaded = True
+        self.mmapped = mmapped
+        self._conn = conn
+        self._lock = lock
+
+    def _call(self, op: str, *args):
+        with self._lock:
+            self._conn.send((op, self.name, args))
+            status, result = self._conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Index shard {self.name}: {result}")
+        return result
+
+    def search(self, queries: np.ndarray, k: int, selector=None, selector_ids: Optional[np.ndarray] = None,
+               exhaustive: bool = False):
+        # FAISS selectors cannot be pickled, so the worker rebuilds one from the ids
+        if selector is not None and selector_ids is None:
+            raise ValueError("Remote shards need selector_ids to filter")
+        return self._call("search", queries, k, None, selector_ids, exhaustive)
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        return self._call("reconstruct", ids)
+
+def _shutdown(executor: ThreadPoolExecutor, workers: list):
+    executor.shutdown(wait=False)
+    for process, conn, lock in workers:
+        try:
+            with lock:
+                conn.send(("stop", None, ()))
+        except (OSError, ValueError):
+            pass
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+class ShardedIndex:
+    """
+    Scatter-gather search over index shards with disjoint global ids.
+
+    Offers the parts of the FAISS index interface the API uses (`d`,
+    `metric_type`, `ntotal`, `search`, `reconstruct_batch`). `names` limits
+    the shards served by this process (all by default); ids of other shards
+    are never returned and cannot be reconstructed.
+    """
+
+    def __init__(self, index_dir: Path, manifest: Dict[str, Any], index_type: Optional[str],
+                 search_params: Dict[str, Any], names: Optional[Sequence[str]] = None,
+                 lazy: bool = False, processes: int = 0, mmap: bool = True):
+        entries = [e for e in manifest["shards"] if not names or e["name"] in names]
+        if not entries:
+            raise ValueError(f"None of the shards {list(names or [])} are in {index_dir / INDEX_SHARDS_DIR}")
+        self.index_dir = index_dir
+        self.shard_by = manifest.get("shard_by")
+        self.d = manifest["dim"]
+        self.metric_type = faiss.METRIC_INNER_PRODUCT
+        self.ntotal = sum(e["ntotal"] for e in entries)
+        self.total_shards = len(manifest["shards"])
+        self.processes = 0
+
+        # id -> position in self.shards, -1 for ids this process does not serve
+        self._owner = np.full(manifest["total_ids"], -1, dtype=np.int16)
+        shard_dir = index_dir / INDEX_SHARDS_DIR
+        for position, entry in enumerate(entries):
+            self._owner[np.load(shard_dir / entry["ids_file"], mmap_mode="r")] = position
+
+        workers = []
+        if processes > 0:
+            # Local stand-in for shard nodes: each worker process hosts a share of the shards
+            ctx = multiprocessing.get_context("spawn")
+            groups = [entries[i::processes] for i in range(min(processes, len(entries)))]
+            conns = {}
+            for group in groups:
+                parent, child = ctx.Pipe()
+                process = ctx.Process(target=serve_shards, daemon=True, name="index-shard-worker",
+                                      args=(child, group, str(index_dir), index_type, search_params, mmap))
+                process.start()
+                lock = threading.Lock()
+                workers.append((process, parent, lock))
+                for entry in group:
+                    conns[entry["name"]] = (parent, lock)
+            mmapped = {}
+            for _, parent, _ in workers:
+                mmapped.update(parent.recv()[1])  # wait until the worker has loaded its shards
+            self.shards: List[Any] = [RemoteShard(e, *conns[e["name"]], mmapped[e["name"]]) for e in entries]
+            self.processes = len(workers)
+        else:
+            self.shards = [LocalShard(e, shard_dir / e["file"], index_type, search_params, mmap) for e in entries]
+            if not lazy:
+                for shard in self.shards:
+                    shard.index()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="index-shard")
+        self._finalizer = weakref.finalize(self, _shutdown, self._executor, workers)
+        logger.info(f"Serving {len(self.shards)} of {self.total_shards} index shards ({self.ntotal} vectors, "
+                    f"by {self.shard_by}, {'in ' + str(self.processes) + ' processes' if self.processes else 'in-process'})")
+
+    def search(self, queries: np.ndarray, k: int, selector=None, selector_ids: Optional[np.ndarray] = None,
+               exhaustive: bool = False):
+        """Top-k over all served shards; with `selector` / `selector_ids` only among those ids"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if len(self.shards) == 1:
+            return self.shards[0].search(queries, k, selector, selector_ids, exhaustive)
+        futures = [self._executor.submit(shard.search, queries, k, selector, selector_ids, exhaustive)
+                   for shard in self.shards]
+        return merge_results([f.result() for f in futures], k)
+
+    def served_ids(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        inside = ids < len(self._owner)
+        return ids[inside][self._owner[ids[inside]] >= 0]
+
+    def serves(self, item_id: int) -> bool:
+        return 0 <= item_id < len(self._owner) and self._owner[item_id] >= 0
+
+    def reconstruct_batch(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        owners = self._owner[ids]
+        if (owners < 0).any():
+            raise RuntimeError(f"ids {ids[owners < 0][:5].tolist()} are not served by this process's shards")
+        out = np.empty((len(ids), self.d), dtype=np.float32)
+        for position in np.unique(owners):
+            mask = owners == position
+            out[mask] = self.shards[position].reconstruct_batch(ids[mask])
+        return out
+
+    @property
+    def mmapped(self) -> bool:
+        """Whether every loaded shard is memory-mapped"""
+        return all(s.mmapped for s in self.shards if s.loaded)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "shard_by": self.shard_by,
+            "total_shards": self.total_shards,
+            "served": [s.name for s in self.shards],
+            "loaded": [s.name for s in self.shards if s.loaded],
+            "processes": self.processes,
+        }
+
+    def close(self):
+        """Stop the search threads and shard worker processes (also done when garbage collected)"""
+        self._finalizer()
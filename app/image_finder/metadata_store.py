@@ -0,0 +1,406 @@
+"""
+Columnar, pre-parsed view of meta.json for the Image Similarity Finder API.
+
+Everything the endpoints need per artwork (parsed title, artist, year, genres)
+is computed once when the index is loaded, and genre / artist lookups go
+through inverted indexes instead of scanning the metadata list per request.
+
+build_index.py also writes the store as plain .npy columns (`meta_columns/`),
+which the API memory-maps read-only so that several worker processes share
+one copy of the metadata through the page cache.
+"""
+import ast
+import json
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+YEAR_PATTERN = re.compile(r'(?<!\d)(1[0-9]{3}|20[0-9]{2})(?!\d)')
+
+COLUMNS_DIR = "meta_columns"
+COLUMNS_FILE = "columns.json"
+COLUMNS_FORMAT = 1
+
+def parse_artwork_title(filename: str) -> str:
+    """
+    Parse artwork filename to extract and format the title.
+
+    Example: "jan-steen_return-of-the-prodigal-son-1670" -> "Return Of The Prodigal Son"
+    """
+    try:
+        # Remove file extension
+        base_name = re.sub(r'\.(jpg|jpeg|png)$', '', filename, flags=re.IGNORECASE)
+
+        # Split by underscore to separate artist and title-year
+        parts = base_name.split('_')
+        if len(parts) < 2:
+            return base_name.replace('-', ' ').title()
+
+        # Get the title part (everything after the first underscore)
+        title_part = '_'.join(parts[1:])
+
+        # Remove year at the end (4 digits)
+        title_part = re.sub(r'-\d{4}$', '', title_part)
+
+        # Remove hash suffixes like _ae9c51ec
+        title_part = re.sub(r'_[a-f0-9]{8}$', '', title_part)
+
+        # Remove trailing numbers that are not years
+        title_part = re.sub(r'-\d+$', '', title_part)
+
+        # Convert to title case
+        title = title_part.replace('-', ' ').title()
+
+        return title
+    except Exception as e:
+        logger.warning(f"Failed to parse artwork title from {filename}: {e}")
+        return filename.replace('-', ' ').title()
+
+def parse_genres(genre: str) -> List[str]:
+    """"['Expressionism', 'Realism']" -> ['Expressionism', 'Realism']"""
+    try:
+        value = ast.literal_eval(genre)
+        if isinstance(value, (list, tuple)):
+            return [str(g) for g in value]
+    except (ValueError, SyntaxError):
+        pass
+    return [genre] if genre else []
+
+def parse_year(title: str) -> int:
+    """Year in the title slug ("rembrandt_supper-at-emmaus-1649" -> 1649), 0 if there is none"""
+    parts = title.split('_', 1)
+    matches = YEAR_PATTERN.findall(parts[-1])
+    return int(matches[-1]) if matches else 0
+
+def normalize_artist(artist: str) -> str:
+    return re.sub(r'[\s_-]+', ' ', artist).strip().lower()
+
+def style_card_fields(title: str) -> Optional[Dict[str, str]]:
+    """Artist / title / year as shown on /style cards, parsed from the `title` field"""
+    title_parts = title.split('_')
+    if len(title_parts) < 2:
+        return None
+    artist = title_parts[0].replace('-', ' ').title()
+    card_title = title_parts[1].replace('-', ' ').title()
+
+    # Extract year if present
+    year = ""
+    if len(title_parts) > 2:
+        # Look for 4-digit year
+        year_match = re.search(r'\b(1[0-9]{3}|2[0-9]{3})\b', title_parts[2])
+        if year_match:
+            year = year_match.group(1)
+    return {"artist": artist, "title": card_title, "year": year}
+
+class StringColumn:
+    """Strings stored as one UTF-8 byte array plus offsets, so the column can be memory-mapped"""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, values: List[Optional[str]]) -> "StringColumn":
+        encoded = [(value or "").encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def save(self, directory: Path, name: str):
+        np.save(directory / f"{name}.offsets.npy", self.offsets)
+        np.save(directory / f"{name}.data.npy", self.data)
+
+    @classmethod
+    def load(cls, directory: Path, name: str, mmap_mode: Optional[str] = "r") -> "StringColumn":
+        return cls(np.load(directory / f"{name}.offsets.npy", mmap_mode=mmap_mode),
+                   np.load(directory / f"{name}.data.npy", mmap_mode=mmap_mode))
+
+def _grouped(groups: List[List[int]]) -> tuple:
+    """CSR layout of id lists: (offsets, ids) with group k at ids[offsets[k]:offsets[k + 1]]"""
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in groups], out=offsets[1:])
+    ids = np.array([i for g in groups for i in g], dtype=np.int64)
+    return offsets, ids
+
+class ContentHashes:
+    """sha256 hex digest of an indexed file -> item id, as sorted arrays that can be memory-mapped"""
+
+    def __init__(self, digests: np.ndarray, ids: np.ndarray):
+        self.digests = digests  # sorted, dtype S64 (hex)
+        self.ids = ids
+
+    @classmethod
+    def from_dict(cls, items: Dict[str, int]) -> "ContentHashes":
+        pairs = sorted(items.items())
+        return cls(np.array([d for d, _ in pairs], dtype="S64"),
+                   np.array([i for _, i in pairs], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def get(self, digest: str) -> Optional[int]:
+        key = digest.encode("ascii")
+        pos = int(np.searchsorted(self.digests, key))
+        if pos < len(self.digests) and self.digests[pos] == key:
+            return int(self.ids[pos])
+        return None
+
+COLUMN_ARRAYS = ("live", "years", "genre_offsets", "genre_codes", "by_genre_offsets", "by_genre_ids",
+                 "by_genre_set_offsets", "by_genre_set_ids", "by_artist_offsets", "by_artist_ids",
+                 "hash_digests", "hash_ids")
+STRING_COLUMNS = ("raw_titles", "display_titles", "artists", "genres", "image_paths")
+
+class MetadataStore:
+    """
+    Columnar metadata with genre and artist inverted indexes.
+
+    Item ids are positions in meta.json (and FAISS ids); removed ids are
+    `None` in meta.json and are never returned by lookups. The store is either
+    built in memory from meta.json (`from_metadata`) or memory-mapped from the
+    column files written by build_index.py (`load`), in which case every worker
+    process shares the same page-cache pages instead of holding its own copy.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], strings: Dict[str, StringColumn],
+                 keys: Dict[str, List[str]], mmap: bool = False):
+        self.live = arrays["live"]
+        self.years = arrays["years"]
+        self._arrays = arrays
+        self._strings = strings
+        self.raw_titles = strings["raw_titles"]
+        self.image_paths = strings["image_paths"]
+        self.genre_names: List[str] = keys["genre_names"]
+        self._genre_sets: List[str] = keys["genre_sets"]
+        self._artists: List[str] = keys["artists"]
+        self.mmap = mmap
+        self.sources = keys.get("sources")  # source file stats the columns were written from
+
+        self._genre_lookup = {name: gid for gid, name in enumerate(self.genre_names)}
+        self._genre_lookup_lower = {name.lower(): gid for name, gid in self._genre_lookup.items()}
+        self._genre_set_lookup = {genre: k for k, genre in enumerate(self._genre_sets)}
+        self._artist_lookup = {artist: k for k, artist in enumerate(self._artists)}
+        self.content_hashes = ContentHashes(arrays["hash_digests"], arrays["hash_ids"])
+
+    @classmethod
+    def from_metadata(cls, metadata: List[Optional[Dict[str, Any]]],
+                      content_hashes: Optional[Dict[str, int]] = None) -> "MetadataStore":
+        """Build the columns from parsed meta.json (and hashes.json items)"""
+        n = len(metadata)
+        live = np.zeros(n, dtype=bool)
+        years = np.zeros(n, dtype=np.int32)
+        strings: Dict[str, List[Optional[str]]] = {name: [None] * n for name in STRING_COLUMNS}
+        item_genres: List[List[int]] = [[] for _ in range(n)]
+
+        genre_names: List[str] = []
+        genre_lookup: Dict[str, int] = {}
+        by_genre: List[List[int]] = []
+        by_genre_set: Dict[str, List[int]] = {}
+        by_artist: Dict[str, List[int]] = {}
+
+        for i, item in enumerate(metadata):
+            if item is None:
+                continue
+            live[i] = True
+            title = str(item.get("title", ""))
+            genre = item.get("genre", "")
+            years[i] = parse_year(title)
+            strings["raw_titles"][i] = title
+            strings["display_titles"][i] = parse_artwork_title(Path(item["image_path"]).name)
+            strings["artists"][i] = item["artist"]
+            strings["genres"][i] = genre
+            strings["image_paths"][i] = item["image_path"]
+
+            for name in parse_genres(genre):
+                gid = genre_lookup.get(name)
+                if gid is None:
+                    gid = genre_lookup[name] = len(genre_names)
+                    genre_names.append(name)
+                    by_genre.append([])
+                item_genres[i].append(gid)
+                by_genre[gid].append(i)
+            by_genre_set.setdefault(genre, []).append(i)
+            by_artist.setdefault(normalize_artist(str(item.get("artist", ""))), []).append(i)
+
+        hashes = ContentHashes.from_dict(content_hashes or {})
+        arrays = {"live": live, "years": years, "hash_digests": hashes.digests, "hash_ids": hashes.ids}
+        arrays["genre_offsets"], genre_codes = _grouped(item_genres)
+        arrays["genre_codes"] = genre_codes.astype(np.int32)
+        arrays["by_genre_offsets"], arrays["by_genre_ids"] = _grouped(by_genre)
+        arrays["by_genre_set_offsets"], arrays["by_genre_set_ids"] = _grouped(list(by_genre_set.values()))
+        arrays["by_artist_offsets"], arrays["by_artist_ids"] = _grouped(list(by_artist.values()))
+        keys = {"genre_names": genre_names, "genre_sets": list(by_genre_set), "artists": list(by_artist)}
+        return cls(arrays, {name: StringColumn.from_strings(values) for name, values in strings.items()}, keys)
+
+    def save(self, directory: Path, sources: Optional[Dict[str, Any]] = None):
+        """Write every column as .npy files plus a small columns.json (keys and format info)"""
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in COLUMN_ARRAYS:
+            np.save(directory / f"{name}.npy", self._arrays[name])
+        for name in STRING_COLUMNS:
+            self._strings[name].save(directory, name)
+        with open(directory / COLUMNS_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"format": COLUMNS_FORMAT, "entries": len(self), "sources": sources or {},
+                       "genre_names": self.genre_names, "genre_sets": self._genre_sets,
+                       "artists": self._artists}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "MetadataStore":
+        """Open columns written by `save`, memory-mapped read-only unless `mmap` is False"""
+        with open(directory / COLUMNS_FILE, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get("format") != COLUMNS_FORMAT:
+            raise ValueError(f"Unsupported metadata column format {info.get('format')} in {directory}")
+        mmap_mode = "r" if mmap else None
+        arrays = {name: np.load(directory / f"{name}.npy", mmap_mode=mmap_mode) for name in COLUMN_ARRAYS}
+        strings = {name: StringColumn.load(directory, name, mmap_mode) for name in STRING_COLUMNS}
+        return cls(arrays, strings, info, mmap=mmap)
+
+    def _group(self, name: str, k: Optional[int]) -> np.ndarray:
+        if k is None:
+            return np.empty(0, dtype=np.int64)
+        offsets = self._arrays[f"{name}_offsets"]
+        return self._arrays[f"{name}_ids"][offsets[k]:offsets[k + 1]]
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def is_live(self, idx: int) -> bool:
+        return 0 <= idx < len(self.live) and bool(self.live[idx])
+
+    def artwork(self, idx: int, score: float) -> Dict[str, Any]:
+        """Pre-formatted metadata of an indexed artwork with its similarity score"""
+        return {
+            "title": self._strings["display_titles"][idx],
+            "artist": self._strings["artists"][idx],
+            "genre": self._strings["genres"][idx],
+            "image_path": self.image_paths[idx],
+            "similarity_score": float(score)
+        }
+
+    def style_card(self, idx: int) -> Optional[Dict[str, str]]:
+        return style_card_fields(self.raw_titles[idx])
+
+    def item_genres(self, idx: int) -> List[str]:
+        offsets = self._arrays["genre_offsets"]
+        return [self.genre_names[gid] for gid in self._arrays["genre_codes"][offsets[idx]:offsets[idx + 1]]]
+
+    def genre_id(self, name: str) -> Optional[int]:
+        gid = self._genre_lookup.get(name)
+        return gid if gid is not None else self._genre_lookup_lower.get(name.lower())
+
+    def ids_with_genre(self, name: str) -> np.ndarray:
+        """Ids of artworks tagged with `name` (among possibly other genres)"""
+        return self._group("by_genre", self.genre_id(name))
+
+    def ids_with_genre_string(self, genre: str) -> np.ndarray:
+        """Ids whose raw meta.json genre string equals `genre`, e.g. "['Impressionism']" """
+        return self._group("by_genre_set", self._genre_set_lookup.get(genre))
+
+    def ids_by_artist(self, artist: str) -> np.ndarray:
+        return self._group("by_artist", self._artist_lookup.get(normalize_artist(artist)))
+
+    def filter_ids(self, genre: Optional[str] = None, artist: Optional[str] = None,
+                   year_min: Optional[int] = None, year_max: Optional[int] = None) -> np.ndarray:
+        """Sorted ids matching every given filter (artworks without a known year never match a year range)"""
+        ids = None
+        if genre:
+            ids = self.ids_with_genre(genre)
+        if artist:
+            by_artist = self.ids_by_artist(artist)
+            ids = by_artist if ids is None else np.intersect1d(ids, by_artist, assume_unique=True)
+        if year_min is not None or year_max is not None:
+            if ids is None:
+                ids = np.flatnonzero(self.live)
+            years = self.years[ids]
+            mask = years > 0
+            if year_min is not None:
+                mask &= years >= year_min
+            if year_max is not None:
+                mask &= years <= year_max
+            ids = ids[mask]
+        return np.flatnonzero(self.live) if ids is None else ids
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.live),
+            "live": int(self.live.sum()),
+            "genres": len(self.genre_names),
+            "artists": len(self._artists),
+            "content_hashes": len(self.content_hashes),
+            "mmap": self.mmap,
+        }
+
+def _source_stats(index_dir: Path) -> Dict[str, Any]:
+    """(size, mtime_ns) of the JSON files the columns are derived from, to detect stale columns"""
+    stats = {}
+    for name in ("meta.json", "hashes.json"):
+        path = index_dir / name
+        if path.exists():
+            st = path.stat()
+            stats[name] = [st.st_size, st.st_mtime_ns]
+        else:
+            stats[name] = None
+    return stats
+
+def read_metadata_json(index_dir: Path):
+    """(meta.json entries, hashes.json items or None)"""
+    with open(index_dir / "meta.json", 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    hashes_path = index_dir / "hashes.json"
+    if not hashes_path.exists():
+        return metadata, None
+    with open(hashes_path, 'r', encoding='utf-8') as f:
+        return metadata, json.load(f)["items"]
+
+def write_metadata_columns(index_dir: Path) -> MetadataStore:
+    """
+    (Re)write `meta_columns/` from meta.json and hashes.json. The new columns
+    are written next to the old ones and swapped in by rename, so processes
+    that still map the old files keep reading consistent data.
+    """
+    metadata, content_hashes = read_metadata_json(index_dir)
+    store = MetadataStore.from_metadata(metadata, content_hashes)
+    target = index_dir / COLUMNS_DIR
+    tmp = index_dir / f"{COLUMNS_DIR}.tmp"
+    old = index_dir / f"{COLUMNS_DIR}.old"
+    shutil.rmtree(tmp, ignore_errors=True)
+    store.save(tmp, sources=_source_stats(index_dir))
+    if target.exists():
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+    logger.info(f"Wrote metadata columns for {len(store)} entries to {target}")
+    return store
+
+def load_metadata(index_dir: Path, mmap: bool = True) -> MetadataStore:
+    """
+    Metadata for the index in `index_dir`: the memory-mapped columns when they
+    are present and up to date with meta.json / hashes.json, else parsed from JSON.
+    """
+    columns_dir = index_dir / COLUMNS_DIR
+    if (columns_dir / COLUMNS_FILE).exists():
+        try:
+            store = MetadataStore.load(columns_dir, mmap=mmap)
+            if store.sources == _source_stats(index_dir):
+                return store
+            logger.warning(f"{columns_dir} is older than meta.json / hashes.json; loading JSON instead")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load {columns_dir}, loading JSON instead: {e}")
+    metadata, content_hashes = read_metadata_json(index_dir)
+    if content_hashes is None:
+        logger.info("No hashes.json found; uploads of indexed images will be re-embedded")
+    return MetadataStore.from_metadata(metadata, content_hashes)
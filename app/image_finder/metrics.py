@@ -0,0 +1,252 @@
+"""
+Request instrumentation for the API.
+
+Histograms and counters for /metrics (Prometheus text exposition format),
+per-stage timers that also attribute time to the request being served, and
+an ASGI middleware that counts and times every request by route template and
+reports the request's stages in a `Server-Timing` header.
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# stage -> seconds spent on behalf of the request currently being handled
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_timings", default=None)
+
+class Histogram:
+    """Thread-safe fixed-bucket histogram (cumulative counts, Prometheus style)"""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            cumulative = []
+            running = 0
+            for c in self._counts:
+                running += c
+                cumulative.append(running)
+            return {
+                "buckets": {str(b): n for b, n in zip(self.buckets + ["+Inf"], cumulative)},
+                "count": self._count,
+                "sum": self._sum,
+            }
+
+class LabeledHistogram:
+    """One `Histogram` per combination of label values, created on first use"""
+
+    def __init__(self, buckets: List[float], label_names: Tuple[str, ...]):
+        self.buckets = buckets
+        self.label_names = label_names
+        self._hists: Dict[tuple, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Histogram:
+        with self._lock:
+            hist = self._hists.get(values)
+            if hist is None:
+                hist = self._hists[values] = Histogram(self.buckets)
+            return hist
+
+    def snapshot(self) -> Dict[tuple, Dict[str, Any]]:
+        with self._lock:
+            hists = dict(self._hists)
+        return {values: hist.snapshot() for values, hist in hists.items()}
+
+class Counter:
+    """Thread-safe counter keyed by a tuple of label values"""
+
+    def __init__(self, label_names: Tuple[str, ...] = ()):
+        self.label_names = label_names
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: str, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def snapshot(self) -> Dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+def add_request_timing(stage: str, seconds: float):
+    """Attribute `seconds` of `stage` to the current request, if any"""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+class StageTimer:
+    """
+    Latency histogram per processing stage (upload read, decode, forward pass,
+    search, ...). Time measured on the request's own task is also added to its
+    Server-Timing breakdown; worker threads only feed the histograms.
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.hists = LabeledHistogram(buckets, ("stage",))
+
+    def observe(self, stage: str, seconds: float, request: bool = True):
+        self.hists.labels(stage).observe(seconds)
+        if request:
+            add_request_timing(stage, seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {values[0]: snap for values, snap in self.hists.snapshot().items()}
+
+class RequestMetrics:
+    """Counters and latency histograms filled in by `RequestMetricsMiddleware`"""
+
+    def __init__(self, buckets: List[float], slow_seconds: float = 0.0):
+        self.requests = Counter(("method", "route", "status"))
+        self.errors = Counter(("route",))
+        self.latency = LabeledHistogram(buckets, ("route",))
+        self.slow_seconds = slow_seconds
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def finished(self, method: str, route: str, status: int, seconds: float, timings: Dict[str, float]):
+        with self._lock:
+            self._in_flight -= 1
+        self.requests.inc(method, route, str(status))
+        if status >= 500:
+            self.errors.inc(route)
+        self.latency.labels(route).observe(seconds)
+        if self.slow_seconds and seconds >= self.slow_seconds:
+            logger.warning(f"Slow request {method} {route} -> {status} in {seconds * 1000:.0f}ms "
+                           f"({format_timings(timings)})")
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{method} {route} -> {status} in {seconds * 1000:.1f}ms ({format_timings(timings)})")
+
+def format_timings(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items()) or "no stages"
+
+def server_timing(timings: Dict[str, float], total: float) -> bytes:
+    parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts).encode("latin-1")
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording every HTTP request in a `RequestMetrics`.
+
+    Requests are labelled by route template (`/image/{image_path:path}`, not
+    the concrete path) to keep the number of series bounded.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        status = 500  # unless a response is started
+        t0 = time.perf_counter()
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings, time.perf_counter() - t0)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        self.metrics.started()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.metrics.finished(scope["method"], route, status, time.perf_counter() - t0, timings)
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Iterable[str], values: Iterable[Any]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class PrometheusText:
+    """Builds a document in the Prometheus text exposition format (version 0.0.4)"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._lines: List[str] = []
+
+    def _header(self, name: str, kind: str, help_text: str) -> str:
+        name = f"{self.prefix}_{name}"
+        self._lines.append(f"# HELP {name} {help_text}")
+        self._lines.append(f"# TYPE {name} {kind}")
+        return name
+
+    def sample(self, kind: str, name: str, help_text: str, samples: Dict[tuple, float],
+               label_names: Tuple[str, ...] = ()):
+        """A counter or gauge; `samples` maps label values to the value"""
+        name = self._header(name, kind, help_text)
+        for values, value in sorted(samples.items()):
+            self._lines.append(f"{name}{_labels(label_names, values)} {float(value)!r}")
+
+    def counter(self, name: str, help_text: str, samples: Dict[tuple, float], label_names: Tuple[str, ...] = ()):
+        self.sample("counter", name, help_text, samples, label_names)
+
+    def gauge(self, name: str, help_text: str, samples: Dict[tuple, float], label_names: Tuple[str, ...] = ()):
+        self.sample("gauge", name, help_text, samples, label_names)
+
+    def histogram(self, name: str, help_text: str, snapshots: Dict[tuple, Dict[str, Any]],
+                  label_names: Tuple[str, ...] = ()):
+        """`snapshots` maps label values to `Histogram.snapshot()`"""
+        name = self._header(name, "histogram", help_text)
+        for values, snap in sorted(snapshots.items()):
+            for bound, count in snap["buckets"].items():
+                labels = _labels(label_names + ("le",), values + (bound,))
+                self._lines.append(f"{name}_bucket{labels} {count}")
+            labels = _labels(label_names, values)
+            self._lines.append(f"{name}_sum{labels} {snap['sum']!r}")
+            self._lines.append(f"{name}_count{labels} {snap['count']}")
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
@@ -0,0 +1,38 @@
+import email.utils
+import os
+
+from http_cache import image_etag, is_not_modified
+
+MTIME = 1_700_000_000.5
+ETAG = '"1a2b-3c"'
+
+def http_date(timestamp):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def test_etag_has_width_suffix_for_thumbnails(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"x" * 10)
+    st = os.stat(path)
+    assert image_etag(st) == f'"a-{st.st_mtime_ns:x}"'
+    assert image_etag(st, 320) == f'"a-{st.st_mtime_ns:x}-w320"'
+
+def test_if_none_match():
+    assert is_not_modified(ETAG, MTIME, ETAG, None)
+    assert is_not_modified(ETAG, MTIME, f'"other", W/{ETAG}', None)
+    assert is_not_modified(ETAG, MTIME, "*", None)
+    assert not is_not_modified(ETAG, MTIME, '"other"', None)
+
+def test_if_none_match_takes_precedence_over_if_modified_since():
+    # A mismatching ETag means modified even though the date says otherwise
+    assert not is_not_modified(ETAG, MTIME, '"other"', http_date(MTIME + 60))
+    # A matching ETag means not modified even though the date is older
+    assert is_not_modified(ETAG, MTIME, ETAG, http_date(MTIME - 60))
+
+def test_if_modified_since():
+    assert is_not_modified(ETAG, MTIME, None, http_date(MTIME))  # second resolution
+    assert is_not_modified(ETAG, MTIME, None, http_date(MTIME + 60))
+    assert not is_not_modified(ETAG, MTIME, None, http_date(MTIME - 60))
+
+def test_invalid_or_missing_validators():
+    assert not is_not_modified(ETAG, MTIME, None, "not a date")
+    assert not is_not_modified(ETAG, MTIME, None, None)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from index_shards import merge_results
+
+def shard(scores, ids):
+    return np.array(scores, dtype=np.float32), np.array(ids, dtype=np.int64)
+
+def test_merge_interleaves_shards_by_score():
+    a = shard([[0.9, 0.5]], [[3, 7]])
+    b = shard([[0.8, 0.7]], [[10, 11]])
+    scores, ids = merge_results([a, b], 3)
+    assert ids.tolist() == [[3, 10, 11]]
+    np.testing.assert_allclose(scores, [[0.9, 0.8, 0.7]])
+
+def test_merge_drops_padding_and_pads_short_results():
+    # FAISS pads rows with id -1 when a shard has fewer than k matches
+    a = shard([[0.4, -3.4e38, -3.4e38]], [[5, -1, -1]])
+    b = shard([[0.6, -3.4e38, -3.4e38]], [[8, -1, -1]])
+    scores, ids = merge_results([a, b], 3)
+    assert ids.tolist() == [[8, 5, -1]]
+    assert scores[0, 2] == -np.inf
+
+def test_merge_keeps_rows_separate():
+    a = shard([[0.9], [0.1]], [[1], [2]])
+    b = shard([[0.2], [0.3]], [[3], [4]])
+    _, ids = merge_results([a, b], 1)
+    assert ids.tolist() == [[1], [4]]
+
+def test_merge_ties_keep_shard_order():
+    a = shard([[0.5]], [[1]])
+    b = shard([[0.5]], [[2]])
+    assert merge_results([a, b], 2)[1].tolist() == [[1, 2]]
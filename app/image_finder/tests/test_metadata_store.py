@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+import pytest
+
+from metadata_store import MetadataStore, load_metadata, write_metadata_columns
+
+META = [
+    {"title": "claude-monet_water-lilies-1916", "artist": "claude monet",
+     "genre": "['Impressionism']", "image_path": "a/claude-monet_water-lilies-1916.jpg"},
+    {"title": "pablo-picasso_guernica-1937", "artist": "pablo picasso",
+     "genre": "['Cubism', 'Expressionism']", "image_path": "b/pablo-picasso_guernica-1937.jpg"},
+    None,  # removed item: its id stays reserved
+    {"title": "claude-monet_impression-sunrise-1872", "artist": "Claude_Monet",
+     "genre": "['Impressionism']", "image_path": "a/claude-monet_impression-sunrise-1872.jpg"},
+    {"title": "unknown_untitled", "artist": "unknown",
+     "genre": "['Expressionism']", "image_path": "c/unknown_untitled.jpg"},
+]
+
+@pytest.fixture(params=["memory", "columns"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MetadataStore.from_metadata(META)
+    (tmp_path / "meta.json").write_text(json.dumps(META), encoding="utf-8")
+    write_metadata_columns(tmp_path)
+    loaded = load_metadata(tmp_path, mmap=True)
+    assert loaded.mmap
+    return loaded
+
+def ids(array):
+    return np.asarray(array).tolist()
+
+def test_no_filter_returns_live_ids(store):
+    assert ids(store.filter_ids()) == [0, 1, 3, 4]
+
+def test_genre_matches_any_tag_case_insensitively(store):
+    assert ids(store.filter_ids(genre="Expressionism")) == [1, 4]
+    assert ids(store.filter_ids(genre="impressionism")) == [0, 3]
+
+def test_artist_is_normalized(store):
+    assert ids(store.filter_ids(artist="Claude Monet")) == [0, 3]
+    assert ids(store.filter_ids(artist="claude-monet")) == [0, 3]
+
+def test_year_range_is_inclusive_and_skips_unknown_years(store):
+    assert ids(store.filter_ids(year_min=1872, year_max=1916)) == [0, 3]
+    assert ids(store.filter_ids(year_min=1900)) == [0, 1]
+    assert ids(store.filter_ids(year_max=1872)) == [3]
+
+def test_filters_combine(store):
+    assert ids(store.filter_ids(genre="Impressionism", artist="claude monet", year_min=1900)) == [0]
+    assert ids(store.filter_ids(genre="Expressionism", year_max=2000)) == [1]
+
+@pytest.mark.parametrize("filters", [
+    {"genre": "Baroque"},
+    {"artist": "rembrandt"},
+    {"year_min": 1950},
+    {"year_min": 1920, "year_max": 1900},
+    {"genre": "Cubism", "artist": "claude monet"},
+])
+def test_no_match_is_empty(store, filters):
+    assert len(store.filter_ids(**filters)) == 0
+
+def test_removed_ids_never_match(store):
+    assert not store.is_live(2)
+    assert 2 not in ids(store.filter_ids(year_min=0))
@@ -0,0 +1,26 @@
+import numpy as np
+
+from vector_store import RerankStore, write_rerank_store
+
+def test_rerank_orders_candidates_by_exact_score():
+    vectors = np.eye(4, dtype=np.float32)
+    store = RerankStore(vectors)
+    query = np.array([[0.1, 0.9, 0.5, 0.0]], dtype=np.float32)
+    scores, ids = store.rerank(query, np.array([[0, 2, 1, -1]]), 2)
+    assert ids.tolist() == [[1, 2]]
+    np.testing.assert_allclose(scores, [[0.9, 0.5]])
+
+def test_rerank_pads_rows_without_candidates():
+    store = RerankStore(np.eye(2, dtype=np.float32))
+    scores, ids = store.rerank(np.ones((1, 2), dtype=np.float32), np.array([[-1, -1]]), 2)
+    assert ids.tolist() == [[-1, -1]]
+    assert np.isneginf(scores).all()
+
+def test_written_store_round_trips(tmp_path):
+    path = tmp_path / "rerank_vectors.npy"
+    chunks = [(0, np.ones((2, 3))), (2, np.full((1, 3), 2.0))]
+    write_rerank_store(path, 3, 3, "fp16", chunks)
+    store = RerankStore.open(path)
+    assert store.vectors.dtype == np.float16
+    assert store.bytes_per_vector == 6
+    np.testing.assert_array_equal(store.get([2, 0]), [[2, 2, 2], [1, 1, 1]])
@@ -0,0 +1,162 @@
+"""
+Downscaled derivatives of artwork images for result cards.
+
+build_index.py pre-generates every indexed image at a few fixed widths under
+`<index_dir>/thumbnails/`; the API serves the nearest width for `/image?size=`
+and renders missing ones on demand into a size-bounded `ThumbnailCache`.
+Both sides name a derivative by the image path recorded in meta.json, the
+source file size and mtime and the width, so they agree on file names and a
+replaced image never gets its predecessor's derivatives.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Sequence, Set, Tuple
+
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = "thumbnails"
+DEFAULT_WIDTHS = (160, 320, 640)
+# format -> (PIL format name, media type)
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+DEFAULT_FORMAT = "webp" if features.check("webp") else "jpeg"
+QUALITY = 80
+
+def parse_widths(value: str) -> Tuple[int, ...]:
+    """"160,320,640" -> (160, 320, 640)"""
+    return tuple(sorted({int(w) for w in value.split(",") if w.strip()}))
+
+def pick_width(requested: int, widths: Sequence[int]) -> int:
+    """Smallest available width covering `requested`, else the largest one"""
+    for width in sorted(widths):
+        if width >= requested:
+            return width
+    return max(widths)
+
+def thumbnail_relpath(image_path: str, source_stat: os.stat_result, width: int, fmt: str) -> Path:
+    """<width>/<xx>/<key>.<fmt>, keyed by the meta.json image path and the source file size and mtime"""
+    key = hashlib.sha1(f"{image_path}|{source_stat.st_size}|{source_stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return Path(str(width)) / key[:2] / f"{key}.{fmt}"
+
+def make_thumbnails(source: str, targets: Iterable[Tuple[int, Path]], fmt: str = DEFAULT_FORMAT,
+                    quality: int = QUALITY) -> int:
+    """
+    Decode `source` once and write a `width`-wide copy to each target path
+    (never upscaled). Returns the number of bytes written.
+    """
+    targets = sorted(targets, key=lambda t: -t[0])
+    pil_format = FORMATS[fmt][0]
+    written = 0
+    with Image.open(source) as img:
+        # JPEG: decode directly at the smallest DCT scale still wider than the largest target
+        img.draft("RGB", (targets[0][0], 1))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        for width, dest in targets:
+            if img.width > width:
+                # Resizing the previous (larger) derivative keeps every step cheap
+                img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            img.save(tmp, pil_format, quality=quality)
+            os.replace(tmp, dest)
+            written += dest.stat().st_size
+    return written
+
+def prune_thumbnails(root: Path, keep: Set[Path]) -> int:
+    """Delete derivatives under `root` whose relative path is not in `keep`"""
+    removed = 0
+    for path in root.glob("*/*/*"):
+        if path.relative_to(root) not in keep:
+            path.unlink()
+            removed += 1
+    return removed
+
+class ThumbnailCache:
+    """
+    On-demand derivatives in a directory capped at `max_bytes`, evicting the
+    least recently served files. Existing files are picked up on first use.
+    Derivatives are handed out as bytes rather than paths, so a concurrent
+    eviction cannot delete a file between lookup and sending it.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, fmt: str = DEFAULT_FORMAT):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fmt = fmt
+        self._files: "OrderedDict[Path, int]" = OrderedDict()  # relpath -> bytes, oldest first
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.root.exists():
+            return
+        found = []
+        for path in self.root.glob("*/*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            st = path.stat()
+            found.append((st.st_atime, path.relative_to(self.root), st.st_size))
+        for _, rel, size in sorted(found):
+            self._files[rel] = size
+            self._bytes += size
+
+    def get(self, rel: Path) -> Optional[bytes]:
+        """Contents of a cached derivative, None if it is not cached (or was evicted meanwhile)"""
+        with self._lock:
+            self._load()
+            if rel not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(rel)
+        try:
+            data = (self.root / rel).read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._files.pop(rel, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def create(self, source: str, rel: Path, width: int) -> bytes:
+        """Render `source` at `width` into the cache and return it (called on a worker thread)"""
+        size = make_thumbnails(source, [(width, self.root / rel)], self.fmt)
+        # Read before registering the file, the point from which other threads may evict it
+        data = (self.root / rel).read_bytes()
+        evicted = []
+        with self._lock:
+            self._load()
+            self._bytes += size - self._files.pop(rel, 0)
+            self._files[rel] = size
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, old_size = self._files.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old)
+            self.evictions += len(evicted)
+        for old in evicted:
+            try:
+                (self.root / old).unlink()
+            except OSError:
+                pass
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"dir": str(self.root), "files": len(self._files), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
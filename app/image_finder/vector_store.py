@@ -0,0 +1,59 @@
+"""
+Full-precision copies of the indexed vectors for reranking compressed indexes.
+
+With a compressed index (fp16 / sq8 / PQ codes) the coarse search returns a
+few times more candidates than requested, and `RerankStore` re-scores them
+exactly against `rerank_vectors.npy`, an (ids x dim) fp32 or fp16 array in id
+order that the API memory-maps read-only. Removed ids are all-zero rows.
+"""
+import os
+from pathlib import Path
+from typing import Iterable, Tuple
+
+import numpy as np
+
+RERANK_FILE = "rerank_vectors.npy"
+RERANK_DTYPES = {"fp32": np.float32, "fp16": np.float16}
+
+def write_rerank_store(path: Path, n: int, d: int, dtype: str,
+                       chunks: Iterable[Tuple[int, np.ndarray]]):
+    """Write `rerank_vectors.npy` from (first id, vectors) chunks without holding all vectors in memory"""
+    tmp = path.with_name(path.name + ".tmp")
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=RERANK_DTYPES[dtype], shape=(n, d))
+    for start, vectors in chunks:
+        out[start:start + len(vectors)] = vectors
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+class RerankStore:
+    """Exact re-scoring of coarse search candidates against stored vectors"""
+
+    def __init__(self, vectors: np.ndarray, candidates_factor: int = 4):
+        self.vectors = vectors
+        self.candidates_factor = max(1, candidates_factor)
+
+    @classmethod
+    def open(cls, path: Path, candidates_factor: int = 4, mmap: bool = True) -> "RerankStore":
+        return cls(np.load(path, mmap_mode="r" if mmap else None), candidates_factor)
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return int(self.vectors.shape[1] * self.vectors.dtype.itemsize)
+
+    def get(self, ids) -> np.ndarray:
+        return np.asarray(self.vectors[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top `k` of each row of `candidates` (ids, -1 = none) by exact inner product with `queries`"""
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, query in enumerate(queries):
+            ids = candidates[row][candidates[row] >= 0]
+            if not len(ids):
+                continue
+            sims = self.get(ids) @ query
+            order = np.argsort(-sims, kind="stable")[:k]
+            scores[row, :len(order)] = sims[order]
+            indices[row, :len(order)] = ids[order]
+        return scores, indices